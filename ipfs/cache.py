@@ -0,0 +1,173 @@
+import os
+import hashlib
+
+from collections import OrderedDict
+
+
+# ============================================================================
+class ReplayCache(object):
+    """ Two-tier cache for immutable IPFS content: an in-process LRU,
+    bounded by total bytes, in front of an optional size-bounded disk cache.
+
+    Keys should identify the content exactly, eg. hash + range.
+    Items larger than max_item_size are not cached.
+    """
+    def __init__(self, mem_size, disk_dir=None, disk_size=0,
+                 max_item_size=None):
+        self.counters = dict(mem_hits=0, disk_hits=0, misses=0,
+                             mem_evictions=0, disk_evictions=0)
+
+        self.mem = MemoryLRUCache(mem_size)
+
+        if disk_dir and disk_size:
+            self.disk = DiskLRUCache(disk_dir, disk_size)
+        else:
+            self.disk = None
+
+        self.max_item_size = max_item_size or mem_size // 8
+
+    def can_cache(self, length):
+        return 0 <= length <= self.max_item_size
+
+    def get(self, key):
+        value = self.mem.get(key)
+        if value is not None:
+            self.counters['mem_hits'] += 1
+            return value
+
+        if self.disk:
+            value = self.disk.get(key)
+            if value is not None:
+                self.counters['disk_hits'] += 1
+                self.counters['mem_evictions'] += self.mem.put(key, value)
+                return value
+
+        self.counters['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        if len(value) > self.max_item_size:
+            return
+
+        self.counters['mem_evictions'] += self.mem.put(key, value)
+
+        if self.disk:
+            self.counters['disk_evictions'] += self.disk.put(key, value)
+
+
+# ============================================================================
+class MemoryLRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        value = self.items.pop(key, None)
+        if value is not None:
+            self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        """ Add value, returning the number of items evicted
+        """
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+
+        self.items[key] = value
+        self.size += len(value)
+
+        evicted = 0
+        while self.size > self.max_size:
+            _, old = self.items.popitem(last=False)
+            self.size -= len(old)
+            evicted += 1
+
+        return evicted
+
+
+# ============================================================================
+class DiskLRUCache(object):
+    """ Stores each item in its own file, named by the sha1 of the key.
+    Existing files are picked up (oldest first) on startup.
+    """
+    def __init__(self, dirname, max_size):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.size = 0
+        self.files = OrderedDict()
+
+        try:
+            os.makedirs(dirname)
+        except:
+            pass
+
+        self._load_existing()
+
+    def _load_existing(self):
+        entries = []
+        for name in os.listdir(self.dirname):
+            filename = os.path.join(self.dirname, name)
+            if name.endswith('.tmp'):
+                os.remove(filename)
+                continue
+
+            stat = os.stat(filename)
+            entries.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(entries):
+            self.files[name] = size
+            self.size += size
+
+        self._evict()
+
+    def _get_name(self, key):
+        return hashlib.sha1(key).hexdigest()
+
+    def get(self, key):
+        name = self._get_name(key)
+        size = self.files.pop(name, None)
+        if size is None:
+            return None
+
+        try:
+            with open(os.path.join(self.dirname, name), 'rb') as fh:
+                value = fh.read()
+        except IOError:
+            self.size -= size
+            return None
+
+        self.files[name] = size
+        return value
+
+    def put(self, key, value):
+        """ Add value, returning the number of items evicted
+        """
+        name = self._get_name(key)
+        if name in self.files:
+            return 0
+
+        filename = os.path.join(self.dirname, name)
+        with open(filename + '.tmp', 'wb') as fh:
+            fh.write(value)
+
+        os.rename(filename + '.tmp', filename)
+
+        self.files[name] = len(value)
+        self.size += len(value)
+
+        return self._evict()
+
+    def _evict(self):
+        evicted = 0
+        while self.size > self.max_size and self.files:
+            name, size = self.files.popitem(last=False)
+            self.size -= size
+            evicted += 1
+            try:
+                os.remove(os.path.join(self.dirname, name))
+            except OSError:
+                pass
+
+        return evicted
@@ -0,0 +1,279 @@
+from ipfs.unixfs import UnixFSBuilder, b58encode, encode_varint
+
+import os
+import time
+import struct
+import uuid
+import tempfile
+import threading
+import traceback
+
+
+# ============================================================================
+class RollingCARWriter(object):
+    """ Packs the IPFS blocks of records into CARv1 files, for import into
+    IPFS in bulk with 'dag import' rather than one add per record.
+
+    write_record() builds the record's DAG locally (see UnixFSBuilder), so
+    its hash is known, and can be indexed, before the daemon has seen it.
+    All blocks of a record go into the same file, whose header lists the
+    root of each record so that they are pinned on import.
+
+    Blocks are appended to <name>.car.open, and the root of each record
+    to <name>.car.roots once all its blocks are written. Once the file
+    grows past max_size bytes or has been open for max_age secs, the
+    header is written and the file renamed to <name>.car, then passed to
+    on_close(filename). Files left open by a previous run are finished
+    by recover().
+    """
+    HASH_SIZE = 34
+
+    EXT = '.car'
+
+    def __init__(self, dirname, max_size=100000000, max_age=300,
+                 on_close=None, prefix='rec-', spool_pool=None):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.max_age = max_age
+        self.on_close = on_close
+        self.prefix = prefix
+        self.spool_pool = spool_pool
+
+        self.builder = UnixFSBuilder()
+
+        self.out = None
+        self.roots_out = None
+        self.filename = None
+        self.opened = None
+        self.roots = []
+        self.lock = threading.Lock()
+        self.closer = None
+
+    def write_record(self, stream):
+        """ Add the blocks of stream to the current file,
+        returning its hash
+        """
+        # serialize the blocks first, so that the file is
+        # only locked while they are copied
+        if self.spool_pool:
+            buff = self.spool_pool.create_spool()
+        else:
+            buff = tempfile.SpooledTemporaryFile(max_size=512*1024)
+
+        try:
+            stream.seek(0)
+            for multihash, block in self.builder.build(stream):
+                buff.write(encode_varint(len(multihash) + len(block)))
+                buff.write(multihash)
+                buff.write(block)
+
+            with self.lock:
+                if not self.out:
+                    self._open()
+
+                buff.seek(0)
+                while True:
+                    chunk = buff.read(64*1024)
+                    if not chunk:
+                        break
+                    self.out.write(chunk)
+
+                # the root is only recorded once the blocks are written
+                self.out.flush()
+                self.roots_out.write(multihash)
+                self.roots_out.flush()
+                self.roots.append(multihash)
+
+                if self.out.tell() >= self.max_size:
+                    closed = self._detach()
+                else:
+                    closed = None
+
+        finally:
+            buff.close()
+
+        if closed:
+            self._finish(*closed)
+
+        return b58encode(multihash)
+
+    def close(self):
+        """ Close the current file, if any
+        """
+        with self.lock:
+            closed = self._detach() if self.out else None
+
+        if closed:
+            self._finish(*closed)
+
+    def recover(self):
+        """ Finish files left open by a previous run (eg. after a crash),
+        with the roots of the records fully written. Must be called
+        before any records are written, and the dir must not be shared
+        with another running writer.
+        """
+        if not os.path.isdir(self.dirname):
+            return
+
+        for name in sorted(os.listdir(self.dirname)):
+            if not name.startswith(self.prefix) or not name.endswith(self.EXT + '.open'):
+                continue
+
+            filename = os.path.join(self.dirname, name[:-len('.open')])
+            try:
+                roots = []
+                if os.path.isfile(filename + '.roots'):
+                    with open(filename + '.roots', 'rb') as fh:
+                        buff = fh.read()
+
+                    for i in range(0, len(buff) - self.HASH_SIZE + 1, self.HASH_SIZE):
+                        roots.append(buff[i:i + self.HASH_SIZE])
+
+                blocks = open(filename + '.open', 'r+b')
+                blocks.truncate(find_sections_end(blocks))
+
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            print('Recovered: ' + filename)
+            self._finish(blocks, filename, None, roots)
+
+    def _open(self):
+        try:
+            os.makedirs(self.dirname)
+        except OSError:
+            pass
+
+        name = self.prefix + time.strftime('%Y%m%d%H%M%S') + '-' + str(uuid.uuid1())
+        self.filename = os.path.join(self.dirname, name + self.EXT)
+        self.out = open(self.filename + '.open', 'w+b')
+        self.roots_out = open(self.filename + '.roots', 'wb')
+        self.opened = time.time()
+
+        if self.max_age and not self.closer:
+            self.closer = threading.Thread(target=self._close_loop)
+            self.closer.daemon = True
+            self.closer.start()
+
+    def _close_loop(self):
+        while True:
+            with self.lock:
+                if self.out:
+                    wait = self.opened + self.max_age - time.time()
+                    closed = self._detach() if wait <= 0 else None
+                else:
+                    wait = self.max_age
+                    closed = None
+
+            if closed:
+                self._finish(*closed)
+            else:
+                time.sleep(wait)
+
+    def _detach(self):
+        """ Start a new file for further records, returning
+        the current one to be finished outside the lock
+        """
+        closed = (self.out, self.filename, self.roots_out, self.roots)
+        self.out = None
+        self.roots_out = None
+        self.filename = None
+        self.roots = []
+        return closed
+
+    def _finish(self, blocks, filename, roots_out, roots):
+        """ Write the header, followed by the blocks, to the final file
+        """
+        if roots_out:
+            roots_out.close()
+
+        # nothing fully written
+        if not roots:
+            blocks.close()
+            os.remove(filename + '.open')
+            if os.path.isfile(filename + '.roots'):
+                os.remove(filename + '.roots')
+            return
+
+        try:
+            with open(filename + '.tmp', 'wb') as out:
+                out.write(encode_car_header(roots))
+
+                blocks.seek(0)
+                while True:
+                    chunk = blocks.read(64*1024)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+
+            blocks.close()
+            os.rename(filename + '.tmp', filename)
+            os.remove(filename + '.open')
+            if os.path.isfile(filename + '.roots'):
+                os.remove(filename + '.roots')
+
+        except Exception:
+            traceback.print_exc()
+            return
+
+        if self.on_close:
+            try:
+                self.on_close(filename)
+            except Exception:
+                traceback.print_exc()
+
+
+# ============================================================================
+def find_sections_end(fh):
+    """ Return the offset after the last complete block section in fh
+    """
+    fh.seek(0, 2)
+    size = fh.tell()
+
+    end = 0
+    while True:
+        fh.seek(end)
+        buff = fh.read(10)
+
+        length = 0
+        shift = 0
+        for i, c in enumerate(buff):
+            length |= (ord(c) & 0x7f) << shift
+            shift += 7
+            if ord(c) < 0x80:
+                break
+        else:
+            return end
+
+        next_end = end + i + 1 + length
+        if next_end > size:
+            return end
+
+        end = next_end
+
+
+def encode_car_header(roots):
+    """ Length-prefixed dag-cbor {'roots': [CIDs], 'version': 1}
+    """
+    buffs = ['\xa2', '\x65roots', encode_cbor_head(4, len(roots))]
+    for multihash in roots:
+        # CID link: tag 42, bytes of the multibase identity prefix + CID
+        buffs.append('\xd8\x2a' + encode_cbor_head(2, len(multihash) + 1))
+        buffs.append('\x00' + multihash)
+
+    buffs.append('\x67version\x01')
+    header = ''.join(buffs)
+    return encode_varint(len(header)) + header
+
+
+def encode_cbor_head(major, value):
+    major <<= 5
+    if value < 24:
+        return struct.pack('>B', major | value)
+    elif value < 0x100:
+        return struct.pack('>BB', major | 24, value)
+    elif value < 0x10000:
+        return struct.pack('>BH', major | 25, value)
+    else:
+        return struct.pack('>BI', major | 26, value)
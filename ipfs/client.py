@@ -0,0 +1,137 @@
+import json
+import uuid
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib import quote
+
+
+# ============================================================================
+class IPFSClient(object):
+    """ Client for the IPFS HTTP API, with a pool of up to pool_size
+    keep-alive connections to the daemon. Once all are in use, further
+    requests wait for a free connection rather than opening more sockets.
+
+    timeout is (connect timeout, read timeout) in secs.
+    """
+    BUFF_SIZE = 64*1024
+
+    def __init__(self, host='localhost', port=5001, pool_size=100,
+                 timeout=(5, 120)):
+        self.url = 'http://{0}:{1}/api/v0/'.format(host, port)
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_size,
+                              pool_block=True)
+        self.session.mount('http://', adapter)
+
+    def _post(self, cmd, params=None, **kwargs):
+        res = self.session.post(self.url + cmd, params=params,
+                                timeout=self.timeout, **kwargs)
+        try:
+            res.raise_for_status()
+        except:
+            res.close()
+            raise
+
+        return res
+
+    def add(self, stream):
+        """ Add a named file-like stream, returning its
+        {'Name', 'Hash', 'Size'} entry
+        """
+        return self.add_many([stream])[0]
+
+    def add_many(self, streams):
+        """ Add all streams in one streamed multipart request, returning
+        an {'Name', 'Hash', 'Size'} entry for each, in order
+        """
+        boundary = uuid.uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary=' + boundary}
+
+        res = self._post('add', headers=headers,
+                         data=self._iter_multipart(streams, boundary))
+
+        results = [json.loads(line) for line in res.iter_lines() if line]
+        results = [entry for entry in results if 'Hash' in entry]
+
+        if len(results) != len(streams):
+            msg = 'IPFS add returned {0} hashes for {1} files'
+            raise IOError(msg.format(len(results), len(streams)))
+
+        return results
+
+    def _iter_multipart(self, streams, boundary):
+        for stream in streams:
+            name = quote(getattr(stream, 'name', None) or 'file', safe='')
+
+            yield '--' + boundary + '\r\n'
+            yield 'Content-Disposition: form-data; name="file"; filename="' + name + '"\r\n'
+            yield 'Content-Type: application/octet-stream\r\n\r\n'
+
+            while True:
+                buff = stream.read(self.BUFF_SIZE)
+                if not buff:
+                    break
+                yield buff
+
+            yield '\r\n'
+
+        yield '--' + boundary + '--\r\n'
+
+    def dag_import(self, streams):
+        """ Import CAR file streams in one request, pinning their roots,
+        returning a {'Cid': {'/': <hash>}, 'PinErrorMsg'} entry for each root
+        """
+        boundary = uuid.uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary=' + boundary}
+
+        res = self._post('dag/import', headers=headers,
+                         data=self._iter_multipart(streams, boundary))
+
+        results = [json.loads(line) for line in res.iter_lines() if line]
+        return [entry['Root'] for entry in results if 'Root' in entry]
+
+    def cat(self, multihash, offset=0, length=-1):
+        """ Return a stream of the content of multihash,
+        from offset for length bytes, or to the end if length < 0
+        """
+        params = {'arg': multihash}
+        if offset > 0:
+            params['offset'] = offset
+
+        if length >= 0:
+            params['length'] = length
+
+        res = self._post('cat', params=params, stream=True)
+        return ResponseStream(res)
+
+    def name_publish(self, multihash):
+        return self._post('name/publish', params={'arg': multihash}).json()
+
+    def name_resolve(self, name=None):
+        """ Resolve an IPNS name, by default that of this node,
+        returning {'Path': '/ipfs/<hash>'}
+        """
+        params = {'arg': name} if name else None
+        return self._post('name/resolve', params=params).json()
+
+
+# ============================================================================
+class ResponseStream(object):
+    """ Streamed response body. Closing it returns the connection to
+    the pool, even if the body was not read in full
+    """
+    def __init__(self, res):
+        self.res = res
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        return self.res.raw.read(size)
+
+    def close(self):
+        self.res.close()
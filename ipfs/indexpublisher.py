@@ -0,0 +1,227 @@
+import json
+import zlib
+import itertools
+
+from bisect import bisect_right
+
+
+# ============================================================================
+class BaseIndexPublisher(object):
+    """ Publishes the Redis CDXJ index to IPFS, streaming lines from Redis
+    page by page so that memory use does not grow with the index.
+
+    RedisIndexer records each added line in the 'changes_key' set, which
+    is used to skip publishing when the index has not changed.
+    """
+    def __init__(self, api, redis, key, page_size=3000):
+        self.api = api
+        self.redis = redis
+        self.key = key
+        self.changes_key = key + ':changed'
+        self.pending_key = key + ':publishing'
+
+        self.page_size = page_size
+
+    def _pop_changes(self):
+        # changes from a failed publish are kept in pending_key and retried
+        pipe = self.redis.pipeline()
+        pipe.sunionstore(self.pending_key, self.pending_key, self.changes_key)
+        pipe.delete(self.changes_key)
+        pipe.smembers(self.pending_key)
+        return pipe.execute()[-1]
+
+    def _finish_changes(self):
+        self.redis.delete(self.pending_key)
+
+    def _iter_pages(self, start=None, end=None):
+        """ Yield lists of up to page_size lines in [start, end)
+        """
+        min_ = '[' + start if start else '-'
+        max_ = '(' + end if end else '+'
+
+        while True:
+            lines = self.redis.zrangebylex(self.key, min_, max_,
+                                           start=0, num=self.page_size)
+            if not lines:
+                break
+
+            yield lines
+            min_ = '(' + lines[-1]
+
+    def _add(self, iter_, name):
+        res = self.api.add(IterStream(iter_, name))
+        return res['Hash']
+
+
+# ============================================================================
+class CDXJIndexPublisher(BaseIndexPublisher):
+    """ Publishes the full index as a single plain sorted CDXJ file
+    """
+    def __init__(self, *args, **kwargs):
+        super(CDXJIndexPublisher, self).__init__(*args, **kwargs)
+        self.published_key = self.key + ':published'
+
+    def publish(self):
+        """ Add the index to IPFS, returning its hash, or None if
+        the index has not changed
+        """
+        changed = self._pop_changes()
+        if not changed and self.redis.exists(self.published_key):
+            return None
+
+        if not self.redis.zcard(self.key):
+            return None
+
+        lines = ('\n'.join(page) + '\n' for page in self._iter_pages())
+        res = self._add(lines, 'index.cdxj')
+
+        self.redis.set(self.published_key, res)
+        self._finish_changes()
+        return res
+
+
+# ============================================================================
+class ZipNumIndexPublisher(BaseIndexPublisher):
+    """ Publishes the index as ZipNum-style shards.
+
+    The sorted index is split into shards, each holding up to
+    blocks_per_shard gzipped blocks of lines_per_block lines. The
+    published object is a summary with a line per block:
+
+        <urlkey timestamp>\\t<shard hash>\\t<offset>\\t<length>\\t<block no>
+
+    The shard hash is also the shard's location, ipfs://<shard hash>
+
+    Only the shards containing lines added since the last publish
+    are rebuilt and re-added.
+    """
+    def __init__(self, api, redis, key, lines_per_block=3000,
+                 blocks_per_shard=100):
+        super(ZipNumIndexPublisher, self).__init__(api, redis, key,
+                                                   page_size=lines_per_block)
+        self.shards_key = key + ':shards'
+        self.blocks_per_shard = blocks_per_shard
+
+    def publish(self):
+        """ Add changed shards and a new summary to IPFS, returning the
+        summary hash, or None if the index has not changed
+        """
+        changed = self._pop_changes()
+
+        shards = self.redis.hgetall(self.shards_key)
+        shards = dict((bound, json.loads(info))
+                      for bound, info in shards.items())
+
+        if shards:
+            if not changed:
+                return None
+
+            # the first shard always starts at '', so every line has a shard
+            bounds = sorted(shards)
+            dirty = set(bounds[bisect_right(bounds, line) - 1]
+                        for line in changed)
+        else:
+            if not self.redis.zcard(self.key):
+                return None
+
+            bounds = ['']
+            dirty = set([''])
+
+        updated = {}
+        for i, bound in enumerate(bounds):
+            if bound in dirty:
+                end = bounds[i + 1] if i + 1 < len(bounds) else None
+                updated.update(self._write_shards(bound, end))
+
+        self.redis.hmset(self.shards_key,
+                         dict((bound, json.dumps(info))
+                              for bound, info in updated.items()))
+
+        shards.update(updated)
+        res = self._add(self._iter_summary(shards), 'index.idx')
+
+        self._finish_changes()
+        return res
+
+    def _write_shards(self, start, end):
+        """ Add all lines in [start, end) as one or more shards,
+        starting a new shard after every blocks_per_shard blocks
+        """
+        shards = {}
+        pages = self._iter_pages(start, end)
+
+        for page in pages:
+            bound = page[0] if shards else start
+
+            shard_pages = itertools.chain([page],
+                                          itertools.islice(pages,
+                                                           self.blocks_per_shard - 1))
+
+            blocks = []
+            res = self._add(self._iter_gzip_blocks(shard_pages, blocks),
+                            'index.cdxj.gz')
+
+            shards[bound] = {'hash': res, 'blocks': blocks}
+
+        return shards
+
+    def _iter_gzip_blocks(self, pages, blocks):
+        """ Yield each page as a gzip member, adding
+        (key, offset, length) for each to blocks
+        """
+        offset = 0
+        for lines in pages:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS + 16)
+            buff = compressor.compress('\n'.join(lines) + '\n')
+            buff += compressor.flush()
+
+            key = ' '.join(lines[0].split(' ', 2)[:2])
+            blocks.append((key, offset, len(buff)))
+            offset += len(buff)
+
+            yield buff
+
+    def _iter_summary(self, shards):
+        lineno = 0
+        for bound in sorted(shards):
+            info = shards[bound]
+            for key, offset, length in info['blocks']:
+                fields = (key, info['hash'], offset, length, lineno)
+                yield '\t'.join(str(field) for field in fields) + '\n'
+                lineno += 1
+
+
+# ============================================================================
+class IterStream(object):
+    """ Read-only named file-like wrapper for an iterator of strings,
+    so that generated content can be streamed into an upload
+    """
+    def __init__(self, iter_, name):
+        self.iter_ = iter_
+        self.name = name
+        self.buff = ''
+
+    def read(self, size=-1):
+        buffs = [self.buff]
+        total = len(self.buff)
+
+        while size is None or size < 0 or total < size:
+            try:
+                buff = next(self.iter_)
+            except StopIteration:
+                break
+
+            buffs.append(buff)
+            total += len(buff)
+
+        buff = ''.join(buffs)
+
+        if size is None or size < 0:
+            self.buff = ''
+            return buff
+
+        self.buff = buff[size:]
+        return buff[:size]
+
+    def close(self):
+        pass
@@ -1,18 +1,26 @@
-from pywb_liverec.warcrecorder import BaseWARCRecorder
+from pywb_liverec.warcrecorder import BaseWARCRecorder, GzipCompressor, CompressionPolicy
 from pywb_liverec.handlers import LiveRecordRewriter
 from pywb_liverec.redisindexer import RedisIndexer
+from pywb_liverec.rollingwriter import RollingWARCWriter
+from pywb_liverec.bloom import RedisBloomFilter
+from pywb_liverec.spool import SpoolPool
+from pywb_liverec.liverec import RecordLimits
+
+from ipfs.client import IPFSClient
+from ipfs.uploader import IPFSUploader, CARUploader, QueueingUploader
+from ipfs.car import RollingCARWriter
+from ipfs.cache import ReplayCache
+from ipfs.indexpublisher import ZipNumIndexPublisher, CDXJIndexPublisher
 
-import os
 import uuid
 
 from io import BytesIO
 
 from urllib import quote_plus
 
-from ipfsApi import Client
 from redis import StrictRedis
 
-from pywb.utils.loaders import LOADERS, BlockLoader, load_yaml_config
+from pywb.utils.loaders import LOADERS, BlockLoader, LimitReader, load_yaml_config
 
 from uwsgidecorators import timer
 
@@ -29,11 +37,141 @@ def init():
     rec_dir = config.get('tmp_rec_dir', '/tmp/rec')
 
     global ipfs_api
-    ipfs_api = Client(ipfs_host, ipfs_port)
+    ipfs_api = IPFSClient(ipfs_host, ipfs_port,
+                          pool_size=config.get('ipfs_pool_size', 100),
+                          timeout=(config.get('ipfs_connect_timeout', 5),
+                                   config.get('ipfs_read_timeout', 120)))
 
     global redis_cli
     redis_cli = StrictRedis.from_url(redis_url)
 
+    global index_publisher
+    if config.get('index_format', 'zipnum') == 'cdxj':
+        index_publisher = CDXJIndexPublisher(ipfs_api, redis_cli, 'ipfs:cdxj',
+                                             page_size=config.get('index_lines_per_block', 3000))
+    else:
+        index_publisher = ZipNumIndexPublisher(ipfs_api, redis_cli, 'ipfs:cdxj',
+                                               lines_per_block=config.get('index_lines_per_block', 3000),
+                                               blocks_per_shard=config.get('index_blocks_per_shard', 100))
+
+    if config.get('dedup') and config.get('dedup_bloom_capacity'):
+        bloom = RedisBloomFilter(redis_cli, 'ipfs:cdxj:dedup:bloom',
+                                 config.get('dedup_bloom_capacity'),
+                                 error_rate=config.get('dedup_bloom_error_rate', 0.001),
+                                 refresh_interval=config.get('dedup_bloom_refresh', 60))
+    else:
+        bloom = None
+
+    # recorder buffers and upload spools share one in-memory budget,
+    # spools roll over to disk once it is used up
+    spool_pool = SpoolPool(max_mem=config.get('spool_mem_budget', 64*1024*1024),
+                           max_size=config.get('spool_max_size', 512*1024))
+
+    # 'record' stores each record as its own IPFS object,
+    # 'rolling' aggregates many records into each uploaded WARC,
+    # 'split' stores the headers and payload of each record separately,
+    # 'car' indexes records by locally computed hashes, importing
+    # their blocks in bulk from CAR files,
+    # 'queue' queues records in redis for separate upload workers
+    storage = config.get('ipfs_storage', 'record')
+
+    global publish_index
+    publish_index = (storage != 'queue')
+
+    if storage == 'car':
+        uploader_cls = CARUploader
+        uploader_kwargs = {}
+    elif storage == 'queue':
+        uploader_cls = QueueingUploader
+        uploader_kwargs = dict(redis=redis_cli,
+                               max_record_size=config.get('queue_max_record_size', 64*1024*1024),
+                               max_pending=config.get('queue_max_pending', 100000))
+    else:
+        uploader_cls = IPFSUploader
+        uploader_kwargs = {}
+
+    global uploader
+    uploader = uploader_cls(ipfs_api,
+                            RedisIndexer(redis_cli, 'ipfs:cdxj',
+                                         changes_key=index_publisher.changes_key,
+                                         dedup_key='ipfs:cdxj:dedup',
+                                         bloom=bloom,
+                                         batch_size=config.get('index_batch_size', 0),
+                                         batch_time=config.get('index_batch_time', 1.0),
+                                         log_ttl=config.get('index_log_ttl', 0)),
+                            rec_dir,
+                            concurrency=config.get('upload_concurrency', 4),
+                            max_queue=config.get('upload_max_queue', 256),
+                            retries=config.get('upload_retries', 5),
+                            backoff=config.get('upload_backoff', 1.0),
+                            max_mem_spool=config.get('upload_max_mem_spool', 256*1024),
+                            spool_pool=spool_pool,
+                            batch_size=config.get('upload_batch_size', 1),
+                            **uploader_kwargs)
+
+    # before recording, rather than on the first dedup lookup
+    if bloom:
+        uploader.indexer.seed_bloom()
+
+    car_writer = None
+    warc_writer = None
+
+    if storage == 'rolling':
+        warc_writer = RollingWARCWriter(rec_dir,
+                                        max_size=config.get('rolling_max_size', 100000000),
+                                        max_age=config.get('rolling_max_age', 300),
+                                        fsync=config.get('rolling_fsync', False),
+                                        on_close=uploader.queue)
+
+        # upload WARCs left open by a previous run
+        warc_writer.recover()
+
+    elif storage == 'car':
+        car_writer = RollingCARWriter(rec_dir,
+                                      max_size=config.get('rolling_max_size', 100000000),
+                                      max_age=config.get('rolling_max_age', 300),
+                                      on_close=uploader.queue,
+                                      spool_pool=spool_pool)
+
+        # import CAR files left open by a previous run
+        car_writer.recover()
+
+    # truncate large responses, and limit reading responses the client
+    # has stopped reading
+    global record_limits
+    record_limits = RecordLimits(max_size=config.get('max_record_size'),
+                                 max_drain_time=config.get('max_drain_time'),
+                                 max_drain_rate=config.get('max_drain_rate'))
+
+    global rec_options
+    rec_options = dict(warc_writer=warc_writer, car_writer=car_writer,
+                       spool_pool=spool_pool,
+                       limits=record_limits, split=(storage == 'split'))
+
+    # write revisit records for payloads already recorded
+    # (not needed when split, as identical payloads are stored once by IPFS)
+    if config.get('dedup') and storage != 'split':
+        rec_options['dedup'] = uploader.indexer
+
+    rec_options['compressor'] = GzipCompressor(level=config.get('gzip_level', 9),
+                                               threads=config.get('gzip_threads', 0),
+                                               parallel_min_size=config.get('gzip_parallel_min_size', 1024*1024))
+
+    # store already compressed payloads at gzip_fast_level instead
+    if config.get('gzip_skip_compressed'):
+        rec_options['policy'] = CompressionPolicy(fast_level=config.get('gzip_fast_level', 0),
+                                                  sample_size=config.get('gzip_sample_size', 4096),
+                                                  min_ratio=config.get('gzip_min_ratio', 0.9))
+
+    global replay_cache
+    if config.get('replay_cache_size'):
+        replay_cache = ReplayCache(config.get('replay_cache_size'),
+                                   disk_dir=config.get('replay_cache_dir'),
+                                   disk_size=config.get('replay_cache_disk_size', 0),
+                                   max_item_size=config.get('replay_cache_max_item'))
+    else:
+        replay_cache = None
+
     LOADERS['ipfs'] = IPFSLoader
 
 
@@ -41,18 +179,96 @@ def init():
 class IPFSLoader(BlockLoader):
     def load(self, url, start=0, length=-1):
         url = url.split('ipfs://')[-1]
-        stream = ipfs_api.cat(url, stream=True)
+
+        # IPFS content is immutable, so hash + range is a safe cache key
+        if not replay_cache or not replay_cache.can_cache(length):
+            return self._load_range(url, start, length)
+
+        key = '{0}:{1}:{2}'.format(url, start, length)
+        buff = replay_cache.get(key)
+        if buff is None:
+            stream = self._load_range(url, start, length)
+            out = BytesIO()
+            try:
+                while True:
+                    buff = stream.read(8192)
+                    if not buff:
+                        break
+                    out.write(buff)
+            finally:
+                stream.close()
+
+            buff = out.getvalue()
+
+            replay_cache.put(key, buff)
+
+        return BytesIO(buff)
+
+    def _load_range(self, url, start, length):
+        # split record: <headers hash>+<payload hash>
+        if '+' in url:
+            return self._load_split(url, length)
+
+        # only fetch the requested range of the object
+        stream = ipfs_api.cat(url, offset=start, length=length)
+
+        # ensure no more than the record is read, even if the
+        # daemon does not support the length param
+        if length >= 0:
+            stream = LimitReader(stream, length)
+
         return stream
 
+    def _load_split(self, url, length):
+        headers_hash, payload_hash = url.split('+', 1)
+
+        stream = ipfs_api.cat(headers_hash)
+        try:
+            headers = stream.read()
+        finally:
+            stream.close()
+
+        stream = ConcatStream([BytesIO(headers),
+                               ipfs_api.cat(payload_hash),
+                               BytesIO('\r\n\r\n')])
+
+        if length >= 0:
+            stream = LimitReader(stream, length)
+
+        return stream
+
+
+#=================================================================
+class ConcatStream(object):
+    """ Reads each of streams in turn
+    """
+    def __init__(self, streams):
+        self.streams = streams
+        self.index = 0
+
+    def read(self, size=-1):
+        while self.index < len(self.streams):
+            buff = self.streams[self.index].read(size)
+            if buff:
+                return buff
+
+            self.index += 1
+
+        return ''
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
+
 
 #=================================================================
 class IPFSRecMaker(object):
-    def __init__(self, api, redis):
-        self.api = api
-        self.redis = redis
+    def __init__(self, uploader, **kwargs):
+        self.uploader = uploader
+        self.kwargs = kwargs
 
     def __call__(self):
-        return IPFSWARCRecorder(rec_dir, self.api, self.redis)
+        return IPFSWARCRecorder(self.uploader, **self.kwargs)
 
 
 #=================================================================
@@ -60,28 +276,28 @@ class IPFSRecorder(LiveRecordRewriter):
     def __init__(self, *args, **kwargs):
         super(IPFSRecorder, self).__init__(*args, **kwargs)
 
-        self.redis = redis_cli
-        self.api = ipfs_api
+        self.uploader = uploader
+        self.rec_options = rec_options
+        self.limits = record_limits
 
     def _get_recorder_factory(self):
-        return IPFSRecMaker(self.api, self.redis)
+        return IPFSRecMaker(self.uploader, **self.rec_options)
 
 
 # ============================================================================
 class IPFSWARCRecorder(BaseWARCRecorder):
-    def __init__(self, warcdir, ipfs, redis):
-        super(IPFSWARCRecorder, self).__init__()
-        self.warcdir = warcdir
-        self.ipfs = ipfs
-        self.redisindex = RedisIndexer(redis, 'ipfs:cdxj')
-
-        # experimental dedup support
-        #self.dedup = self.redisindex
-
-        try:
-            os.makedirs(warcdir)
-        except:
-            pass
+    def __init__(self, uploader, warc_writer=None, car_writer=None,
+                 split=False, **kwargs):
+        # split records are stored uncompressed,
+        # so that the payload is stored as is
+        if split:
+            kwargs['gzip'] = False
+
+        super(IPFSWARCRecorder, self).__init__(**kwargs)
+        self.uploader = uploader
+        self.warc_writer = warc_writer
+        self.car_writer = car_writer
+        self.split = split
 
     def write_records(self):
         resp_uuid = str(uuid.uuid1())
@@ -90,71 +306,74 @@ class IPFSWARCRecorder(BaseWARCRecorder):
         req_uuid = str(uuid.uuid1())
         req_id = self._make_warc_id(req_uuid)
 
-        filename = os.path.join(self.warcdir, resp_uuid + '.warc.gz')
-
-        with open(filename, 'w') as out:
+        # append to the current rolling WARC, uploaded as a whole when closed
+        # the request is written too, so that the indexer pairs each response
+        # with its request rather than with the next record in the file
+        if self.warc_writer:
+            out = self.uploader.create_spool()
+            try:
+                self._write_warc_response(out, warc_id=resp_id)
+                self._write_warc_request(out, warc_id=req_id, concur_id=resp_id)
+
+                self.warc_writer.write_record(out)
+            finally:
+                out.close()
+            return
+
+        # index by the locally computed hash right away,
+        # the blocks are imported with the rest of the CAR file
+        if self.car_writer:
+            out = self.uploader.create_spool()
+            try:
+                self._write_warc_response(out, warc_id=resp_id)
+
+                multihash = self.car_writer.write_record(out)
+                self.uploader.indexer.add_record(out, 'ipfs://' + multihash)
+            finally:
+                out.close()
+            return
+
+        # serialize into an in-memory spool (unless the record is large),
+        # upload and indexing happen in the background
+        # the spool is closed by the uploader once queued
+        out = self.uploader.create_spool()
+        try:
+            payload_len = self.resp_buff.tell() - self.payload_offset
             self._write_warc_response(out, warc_id=resp_id)
-            out.flush()
-
-        # for now, not writing 'request'
-        #with open(os.path.join(self.warcdir, req_uuid + '.warc.gz'), 'w') as out:
-        #    self._write_warc_request(out, warc_id=req_id, concur_id=resp_id)
-
-        with open(filename, 'r') as stream:
-            stream = CustomNameStream(stream, quote_plus(self.url))
-            res = self.ipfs.add(stream)
-            if not res:
-                print('IPFS ADD FAILED')
 
-            else:
-                path = 'ipfs://' + res['Hash']
-                self.redisindex.add_record(stream, path)
+            # the record is uploaded as a headers object and a payload object,
+            # the payload object being the same for identical payloads.
+            # the record ends with the payload, then \r\n\r\n
+            split = None
+            if self.split and self.payload_offset:
+                split = (out.tell() - payload_len - 4, payload_len)
 
-        os.remove(filename)
+            # for now, not writing 'request'
+            #self._write_warc_request(out, warc_id=req_id, concur_id=resp_id)
 
+        except:
+            out.close()
+            raise
 
-# ============================================================================
-class CustomNameStream(object):
-    """ Wrapper to specify custom name for file
-    """
-    def __init__(self, stream, name):
-        self.stream = stream
-        self._name = name
-
-    @property
-    def name(self):
-        return self._name
-
-    def read(self, maxlen=None):
-        return self.stream.read(maxlen)
-
-    def readinto(self, buff):
-        return self.stream.readinto(buff)
-
-    def close(self):
-        return self.stream.close()
-
-    def tell(self):
-        return self.stream.tell()
-
-    def seek(self, *args, **kwargs):
-        return self.stream.seek(*args, **kwargs)
+        self.uploader.queue(out, quote_plus(self.url), split)
 
 
 @timer(30, target='mule')
 def update_index(signum):
-    """ Periodically update the index from Redis and put into IPFS
+    """ Periodically publish the index from Redis to IPFS, if changed
     """
-    cdx = redis_cli.zrange('ipfs:cdxj', 0, -1)
-    cdx = ''.join(cdx)
-    buff = BytesIO(cdx)
+    # published by the upload workers instead
+    if not publish_index:
+        return
+
+    res = index_publisher.publish()
+    if not res:
+        return
 
-    # Add New Index
-    res = ipfs_api.add(CustomNameStream(buff, 'index.cdxj'))
-    print('Updating Index: ' + str(res))
+    print('Updating Index: ' + res)
 
     # Register with IPNS
-    res = ipfs_api.name_publish(res['Hash'])
+    res = ipfs_api.name_publish(res)
     print res
 
 
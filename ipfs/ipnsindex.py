@@ -0,0 +1,280 @@
+from pywb.cdx.cdxsource import CDXSource
+from pywb.utils.binsearch import binsearch, iter_range
+
+from ipfs.client import IPFSClient
+from ipfs.cache import ReplayCache
+
+from gevent import spawn
+
+import os
+import mmap
+import time
+import zlib
+import shutil
+import itertools
+import threading
+import traceback
+
+
+# ============================================================================
+class IPNSCDXSource(CDXSource):
+    """ Serves lookups from the index published to IPNS by update_index,
+    without Redis.
+
+    The IPNS name (by default, that of the local IPFS node) is resolved
+    every refresh_interval secs. Each new version of the index is
+    downloaded to cache_dir and memory-mapped, replacing the previous one
+    once ready. Lookups are binary searches over the mapped file.
+
+    Both index formats are supported: a plain CDXJ index is searched
+    directly; for a ZipNum summary, the matching blocks are fetched from
+    their shards in IPFS, and kept decompressed in an LRU cache of up to
+    block_cache_size bytes.
+    """
+    def __init__(self, ipfs_host='localhost', ipfs_port=5001, name=None,
+                 cache_dir='/tmp/ipns-index', refresh_interval=60,
+                 block_cache_size=32000000, config=None):
+        self.api = IPFSClient(ipfs_host, ipfs_port)
+        self.name = name
+        self.cache_dir = cache_dir
+        self.refresh_interval = refresh_interval
+
+        # shards are immutable, so their blocks are shared by all versions
+        self.block_cache = ReplayCache(block_cache_size) if block_cache_size else None
+
+        self.index = None
+        self.last_refresh = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+
+    def load_cdx(self, query):
+        index = self._get_index()
+        if not index:
+            return iter([])
+
+        return index.load_cdx(query)
+
+    def _get_index(self):
+        if time.time() - self.last_refresh >= self.refresh_interval:
+            if self.index:
+                # keep serving the current version meanwhile
+                if not self.refreshing:
+                    self.refreshing = True
+                    spawn(self._refresh)
+            else:
+                with self.lock:
+                    if not self.index:
+                        self._load_cached()
+                        self._refresh()
+
+        return self.index
+
+    def _refresh(self):
+        try:
+            self.last_refresh = time.time()
+
+            path = self.api.name_resolve(self.name)['Path']
+            multihash = path.rsplit('/', 1)[-1]
+
+            if not self.index or self.index.multihash != multihash:
+                self._download(multihash)
+                self._open(multihash)
+
+        except Exception:
+            traceback.print_exc()
+
+        finally:
+            self.refreshing = False
+
+    def _load_cached(self):
+        """ Start with the most recent version downloaded, if any
+        """
+        names = [name for name in os.listdir(self.cache_dir)
+                 if not name.endswith('.tmp')]
+
+        if names:
+            filename = lambda name: os.path.join(self.cache_dir, name)
+            self._open(max(names, key=lambda name: os.path.getmtime(filename(name))))
+
+    def _download(self, multihash):
+        filename = os.path.join(self.cache_dir, multihash)
+        if os.path.isfile(filename):
+            return
+
+        stream = self.api.cat(multihash)
+        try:
+            with open(filename + '.tmp', 'wb') as out:
+                shutil.copyfileobj(stream, out)
+        finally:
+            stream.close()
+
+        os.rename(filename + '.tmp', filename)
+
+    def _open(self, multihash):
+        filename = os.path.join(self.cache_dir, multihash)
+
+        with open(filename, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        first_line = MMapReader(mm).readline()
+        if '\t' in first_line:
+            index = ZipNumIndex(multihash, mm, self.api, self.block_cache)
+        else:
+            index = CDXJIndex(multihash, mm)
+
+        # lookups already running keep the previous version,
+        # which is unmapped once no longer referenced
+        self.index = index
+
+        for name in os.listdir(self.cache_dir):
+            if name != multihash and not name.endswith('.tmp'):
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+# ============================================================================
+class CDXJIndex(object):
+    def __init__(self, multihash, mm):
+        self.multihash = multihash
+        self.mm = mm
+
+    def load_cdx(self, query):
+        return iter_range(MMapReader(self.mm), query.key, query.end_key)
+
+
+# ============================================================================
+class ZipNumIndex(object):
+    """ ZipNum summary, one line per gzipped block of index lines:
+
+        <urlkey timestamp>\\t<shard hash>\\t<offset>\\t<length>\\t<block no>
+    """
+    def __init__(self, multihash, mm, api, cache=None):
+        self.multihash = multihash
+        self.mm = mm
+        self.api = api
+        self.cache = cache
+
+    def load_cdx(self, query):
+        blocks = self._iter_blocks(query.key, query.end_key)
+        lines = self._iter_lines(blocks)
+
+        lines = itertools.dropwhile(lambda line: line < query.key, lines)
+        return itertools.takewhile(lambda line: line < query.end_key, lines)
+
+    def _iter_blocks(self, start, end):
+        """ Summary lines of the blocks which may contain lines in [start, end):
+        the last block starting before start, and all starting before end
+        """
+        lines = binsearch(MMapReader(self.mm), start)
+
+        prev = None
+        line = None
+        for line in lines:
+            if line >= start:
+                break
+            prev = line
+        else:
+            line = None
+
+        if prev:
+            yield prev
+
+        while line and line < end:
+            yield line
+            line = next(lines, None)
+
+    def _iter_lines(self, blocks):
+        # fetch consecutive uncached blocks from the same shard in one request
+        group = []
+        for block in blocks:
+            shard, offset, length = block.split('\t')[1:4]
+            offset = int(offset)
+            length = int(length)
+
+            buff = self.cache.get(self._cache_key(shard, offset)) if self.cache else None
+
+            if group and (buff is not None or group[0][0] != shard or
+                          group[-1][1] + group[-1][2] != offset):
+                for line in self._load_group(group):
+                    yield line
+                group = []
+
+            if buff is not None:
+                for line in buff.splitlines():
+                    yield line
+            else:
+                group.append((shard, offset, length))
+
+        if group:
+            for line in self._load_group(group):
+                yield line
+
+    def _load_group(self, group):
+        shard, offset, _ = group[0]
+        total = sum(length for _, _, length in group)
+
+        stream = self.api.cat(shard, offset=offset, length=total)
+        try:
+            for _, offset, length in group:
+                buff = self._read_fully(stream, length)
+                buff = zlib.decompress(buff, zlib.MAX_WBITS + 16)
+                if self.cache:
+                    self.cache.put(self._cache_key(shard, offset), buff)
+
+                for line in buff.splitlines():
+                    yield line
+        finally:
+            stream.close()
+
+    @staticmethod
+    def _cache_key(shard, offset):
+        return shard + ':' + str(offset)
+
+    @staticmethod
+    def _read_fully(stream, length):
+        buffs = []
+        while length > 0:
+            buff = stream.read(length)
+            if not buff:
+                raise IOError('Truncated index block')
+
+            buffs.append(buff)
+            length -= len(buff)
+
+        return ''.join(buffs)
+
+
+# ============================================================================
+class MMapReader(object):
+    """ Reader with its own position over a shared mmap, so that
+    concurrent lookups do not move each other's position
+    """
+    def __init__(self, mm):
+        self.mm = mm
+        self.pos = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 2:
+            self.pos = len(self.mm) + offset
+        elif whence == 1:
+            self.pos += offset
+        else:
+            self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def readline(self):
+        end = self.mm.find('\n', self.pos)
+        if end < 0:
+            end = len(self.mm)
+        else:
+            end += 1
+
+        line = self.mm[self.pos:end]
+        self.pos = end
+        return line
@@ -0,0 +1,158 @@
+import hashlib
+
+
+# ============================================================================
+class UnixFSBuilder(object):
+    """ Builds the IPFS file DAG of a stream locally, with the same layout
+    as the daemon's default 'ipfs add' (CIDv0): chunks of chunk_size
+    bytes as dag-pb/unixfs leaves, in a balanced tree of up to max_links
+    links per node. The resulting root hash is the one the daemon
+    would return for the same content.
+
+    build() yields (multihash, block) for each node, children before
+    their parents, the root last.
+    """
+    CHUNK_SIZE = 256*1024
+    MAX_LINKS = 174
+
+    # unixfs Data.Type
+    FILE = 2
+
+    def __init__(self, chunk_size=CHUNK_SIZE, max_links=MAX_LINKS):
+        self.chunk_size = chunk_size
+        self.max_links = max_links
+
+    def build(self, stream):
+        # pending links of each level of the tree, leaves first:
+        # [(multihash, file size, total block size)]
+        levels = [[]]
+        count = 0
+
+        while True:
+            buff = read_fully(stream, self.chunk_size)
+            if not buff and count:
+                break
+
+            count += 1
+            block = self._encode_node([], self._encode_data(buff, len(buff)))
+            multihash = get_multihash(block)
+            yield multihash, block
+
+            levels[0].append((multihash, len(buff), len(block)))
+            if len(levels[0]) == self.max_links:
+                for res in self._flush_full(levels):
+                    yield res
+
+            if len(buff) < self.chunk_size:
+                break
+
+        # a single leaf is its own root, otherwise complete each
+        # level up to the one with a single node
+        i = 0
+        while i < len(levels) - 1 or len(levels[i]) > 1:
+            if levels[i]:
+                for res in self._flush(levels, i):
+                    yield res
+            i += 1
+
+    def _flush_full(self, levels):
+        i = 0
+        while len(levels[i]) == self.max_links:
+            for res in self._flush(levels, i):
+                yield res
+            i += 1
+
+    def _flush(self, levels, i):
+        """ Replace the pending links of level i with a node linking them
+        """
+        links = levels[i]
+        levels[i] = []
+        if i + 1 == len(levels):
+            levels.append([])
+
+        filesize = sum(link[1] for link in links)
+        data = self._encode_data(None, filesize, [link[1] for link in links])
+        block = self._encode_node(links, data)
+        multihash = get_multihash(block)
+        yield multihash, block
+
+        total = len(block) + sum(link[2] for link in links)
+        levels[i + 1].append((multihash, filesize, total))
+
+    def _encode_data(self, buff, filesize, blocksizes=()):
+        data = encode_varint_field(1, self.FILE)
+        if buff:
+            data += encode_bytes_field(2, buff)
+
+        data += encode_varint_field(3, filesize)
+        for size in blocksizes:
+            data += encode_varint_field(4, size)
+
+        return data
+
+    def _encode_node(self, links, data):
+        # dag-pb: links first, then data
+        buffs = []
+        for multihash, _, total in links:
+            link = (encode_bytes_field(1, multihash) +
+                    encode_bytes_field(2, '') +
+                    encode_varint_field(3, total))
+            buffs.append(encode_bytes_field(2, link))
+
+        buffs.append(encode_bytes_field(1, data))
+        return ''.join(buffs)
+
+
+# ============================================================================
+def get_multihash(block):
+    """ sha2-256 multihash of block, which is also its CIDv0
+    """
+    return '\x12\x20' + hashlib.sha256(block).digest()
+
+
+def read_fully(stream, size):
+    buffs = []
+    while size > 0:
+        buff = stream.read(size)
+        if not buff:
+            break
+
+        buffs.append(buff)
+        size -= len(buff)
+
+    return ''.join(buffs)
+
+
+def encode_varint(value):
+    buff = bytearray()
+    while value >= 0x80:
+        buff.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    buff.append(value)
+    return str(buff)
+
+
+def encode_varint_field(num, value):
+    return encode_varint(num << 3) + encode_varint(value)
+
+
+def encode_bytes_field(num, buff):
+    return encode_varint((num << 3) | 2) + encode_varint(len(buff)) + buff
+
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+def b58encode(buff):
+    """ base58btc, as used for CIDv0 strings ('Qm...')
+    """
+    value = int(buff.encode('hex') or '0', 16)
+
+    chars = []
+    while value:
+        value, rem = divmod(value, 58)
+        chars.append(B58_ALPHABET[rem])
+
+    pad = len(buff) - len(buff.lstrip('\x00'))
+    return B58_ALPHABET[0] * pad + ''.join(reversed(chars))
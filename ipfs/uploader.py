@@ -0,0 +1,359 @@
+import os
+import json
+import atexit
+import uuid
+import shutil
+import tempfile
+import traceback
+
+from gevent import sleep, spawn
+from gevent.pool import Pool
+from gevent.queue import Queue, Empty
+
+
+# ============================================================================
+class IPFSUploader(object):
+    """ Background uploader for recorded WARC records.
+
+    Recorders serialize the record into a spool (see create_spool()) or a
+    file in the spool dir and queue it here. A bounded pool of greenlets
+    adds records to IPFS, up to batch_size records already queued in each
+    add request, and indexes them, retrying failed adds with
+    exponential backoff. Once max_queue records are waiting, queue()
+    blocks the caller until the uploads catch up.
+
+    If a SpoolPool is given, spools are created from it, sharing its
+    memory budget.
+
+    A record queued with split=(header_len, payload_len) is added as two
+    objects, its headers and its payload, and indexed as
+    ipfs://<headers hash>+<payload hash>.
+
+    Spools which still fail are written to the spool dir, as are spools
+    still queued or being uploaded when the process exits. Files left in
+    the spool dir (eg. after a restart) are re-queued when the uploader
+    is first started.
+    """
+    SPOOL_EXT = '.warc.gz'
+
+    def __init__(self, api, indexer, spool_dir,
+                 concurrency=4, max_queue=256, retries=5, backoff=1.0,
+                 max_mem_spool=256*1024, spool_pool=None, batch_size=1):
+        self.api = api
+        self.indexer = indexer
+        self.spool_dir = spool_dir
+        self.max_mem_spool = max_mem_spool
+        self.spool_pool = spool_pool
+
+        self.retries = retries
+        self.backoff = backoff
+        self.batch_size = batch_size
+
+        self.pending = Queue(maxsize=max_queue)
+        self.pool = Pool(concurrency)
+        self.dispatcher = None
+        self.active = set()
+        # sources taken from the queue, until uploaded or saved
+        self.uploading = set()
+
+        self.counters = dict(queued=0, uploaded=0, retried=0, failed=0)
+
+        try:
+            os.makedirs(spool_dir)
+        except:
+            pass
+
+    def create_spool(self):
+        """ Return a buffer for serializing a record, kept in memory
+        unless the record is larger than max_mem_spool
+        """
+        if self.spool_pool:
+            return self.spool_pool.create_spool(self.max_mem_spool)
+
+        return tempfile.SpooledTemporaryFile(max_size=self.max_mem_spool)
+
+    def spool_filename(self, name):
+        """ Return a (temp, final) filename pair for spooling a new record
+        """
+        filename = os.path.join(self.spool_dir, name + self.SPOOL_EXT)
+        return filename + '.tmp', filename
+
+    def queue(self, source, name=None, split=None):
+        """ Queue a spooled filename or a spool from create_spool()
+        for upload. A queued spool is closed once uploaded.
+        """
+        if isinstance(source, str):
+            self.active.add(source)
+            name = name or os.path.basename(source)
+
+        if not self.dispatcher:
+            self.start()
+
+        self.counters['queued'] += 1
+        self.pending.put((source, name, split))
+
+    def start(self):
+        if self.dispatcher:
+            return
+
+        self.dispatcher = spawn(self._dispatch)
+        atexit.register(self.save_pending)
+
+        for name in sorted(os.listdir(self.spool_dir)):
+            filename = os.path.join(self.spool_dir, name)
+            if name.endswith(self.SPOOL_EXT) and filename not in self.active:
+                self.queue(filename)
+
+    def _dispatch(self):
+        while True:
+            batch = [self.pending.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except Empty:
+                    break
+
+            self.uploading.update(source for source, name, split in batch)
+
+            # blocks while all upload slots are busy
+            self.pool.spawn(self._upload, batch)
+
+    def _upload(self, batch):
+        try:
+            if self._upload_with_retry(batch):
+                return
+
+            # spools saved for retry on restart are uploaded whole
+            for source, name, split in batch:
+                if isinstance(source, str):
+                    print('IPFS ADD FAILED: ' + source)
+                else:
+                    print('IPFS ADD FAILED, saved as: ' + self._save_spool(source))
+
+        finally:
+            for source, name, split in batch:
+                self.uploading.discard(source)
+                if isinstance(source, str):
+                    self.active.discard(source)
+                else:
+                    source.close()
+
+    def _upload_with_retry(self, batch):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.counters['retried'] += 1
+                sleep(self.backoff * (2 ** (attempt - 1)))
+
+            try:
+                self.upload_batch(batch)
+
+                for source, name, split in batch:
+                    if isinstance(source, str):
+                        os.remove(source)
+
+                self.counters['uploaded'] += len(batch)
+                return True
+
+            except Exception:
+                traceback.print_exc()
+
+        self.counters['failed'] += len(batch)
+        return False
+
+    def _save_spool(self, stream):
+        """ Keep a failed spool in the spool dir to be retried on restart
+        """
+        tmp_filename, filename = self.spool_filename(str(uuid.uuid1()))
+        stream.seek(0)
+        with open(tmp_filename, 'wb') as out:
+            shutil.copyfileobj(stream, out)
+
+        os.rename(tmp_filename, filename)
+        return filename
+
+    def save_pending(self):
+        """ Save spools not yet uploaded to the spool dir, to be
+        uploaded on restart. Run at exit, as they are only in memory
+        """
+        sources = list(self.uploading)
+        while True:
+            try:
+                sources.append(self.pending.get_nowait()[0])
+            except Empty:
+                break
+
+        for source in sources:
+            if isinstance(source, str) or source.closed:
+                continue
+
+            try:
+                print('Saved pending upload as: ' + self._save_spool(source))
+            except Exception:
+                traceback.print_exc()
+
+    def upload_batch(self, batch):
+        """ Add all (source, name, split) records in one request,
+        then index each
+        """
+        # the daemon adds the files of a request to one directory, so
+        # names are prefixed by their position to keep them unique
+        streams = []
+        parts = []
+        try:
+            for source, name, split in batch:
+                if isinstance(source, str):
+                    stream = open(source, 'rb')
+                else:
+                    stream = source
+                    stream.seek(0)
+
+                streams.append(CustomNameStream(stream, name))
+
+                if split:
+                    header_len, payload_len = split
+                    parts.append(PartStream(stream, 0, header_len,
+                                            '%d-%s' % (len(parts), name)))
+                    parts.append(PartStream(stream, header_len, payload_len,
+                                            '%d-%s' % (len(parts), name)))
+                else:
+                    parts.append(CustomNameStream(stream, '%d-%s' % (len(parts), name)))
+
+            results = iter(self.api.add_many(parts))
+
+            for stream, (source, name, split) in zip(streams, batch):
+                path = 'ipfs://' + next(results)['Hash']
+                if split:
+                    path += '+' + next(results)['Hash']
+
+                self.indexer.add_record(stream, path)
+
+        finally:
+            for stream, (source, name, split) in zip(streams, batch):
+                if isinstance(source, str):
+                    stream.close()
+
+
+# ============================================================================
+class QueueingUploader(IPFSUploader):
+    """ Queues records in Redis, for upload and indexing by any number of
+    UploadWorker processes (see ipfs/worker.py), rather than uploading
+    them in this process.
+
+    The record is stored under <key>:record:<id>, and an entry for it
+    pushed to the <key>:pending list. Records larger than max_record_size,
+    or queued while max_pending entries are already pending (eg. if no
+    workers are running), are uploaded in this process instead.
+    """
+    def __init__(self, api, indexer, spool_dir, redis, key='ipfs:upload',
+                 max_record_size=64*1024*1024, max_pending=100000, **kwargs):
+        super(QueueingUploader, self).__init__(api, indexer, spool_dir, **kwargs)
+        self.redis = redis
+        self.key = key
+        self.pending_key = key + ':pending'
+        self.max_record_size = max_record_size
+        self.max_pending = max_pending
+
+        self.counters['queued_redis'] = 0
+
+    def queue(self, source, name=None, split=None):
+        if isinstance(source, str):
+            return super(QueueingUploader, self).queue(source, name, split)
+
+        try:
+            source.seek(0, 2)
+            if (source.tell() > self.max_record_size or
+                self.redis.llen(self.pending_key) >= self.max_pending):
+                return super(QueueingUploader, self).queue(source, name, split)
+
+            source.seek(0)
+            buff = source.read()
+
+            id_ = uuid.uuid1().hex
+            entry = json.dumps(dict(id=id_, name=name, split=split))
+
+            pipe = self.redis.pipeline()
+            pipe.set(self.key + ':record:' + id_, buff)
+            pipe.lpush(self.pending_key, entry)
+            pipe.execute()
+
+        except Exception:
+            traceback.print_exc()
+            return super(QueueingUploader, self).queue(source, name, split)
+
+        source.close()
+        self.counters['queued_redis'] += 1
+
+
+# ============================================================================
+class CARUploader(IPFSUploader):
+    """ Imports CAR files of records (see RollingCARWriter) with dag import.
+    The records are already indexed by their locally computed hashes.
+    """
+    SPOOL_EXT = '.car'
+
+    def upload_batch(self, batch):
+        streams = [CustomNameStream(open(source, 'rb'), name)
+                   for source, name, split in batch]
+        try:
+            results = self.api.dag_import(streams)
+        finally:
+            for stream in streams:
+                stream.close()
+
+        for entry in results:
+            if entry.get('PinErrorMsg'):
+                msg = 'IPFS dag import, pinning {0} failed: {1}'
+                raise IOError(msg.format(entry['Cid']['/'], entry['PinErrorMsg']))
+
+
+# ============================================================================
+class CustomNameStream(object):
+    """ Wrapper to specify custom name for file
+    """
+    def __init__(self, stream, name):
+        self.stream = stream
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name
+
+    def read(self, maxlen=None):
+        return self.stream.read(maxlen)
+
+    def readinto(self, buff):
+        return self.stream.readinto(buff)
+
+    def close(self):
+        return self.stream.close()
+
+    def tell(self):
+        return self.stream.tell()
+
+    def seek(self, *args, **kwargs):
+        return self.stream.seek(*args, **kwargs)
+
+
+# ============================================================================
+class PartStream(object):
+    """ Named read-only view of length bytes from start of a seekable stream
+    """
+    def __init__(self, stream, start, length, name):
+        self.stream = stream
+        self.start = start
+        self.length = length
+        self.name = name
+        self.pos = 0
+
+    def read(self, size=-1):
+        remaining = self.length - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+
+        if not size:
+            return ''
+
+        self.stream.seek(self.start + self.pos)
+        buff = self.stream.read(size)
+        self.pos += len(buff)
+        return buff
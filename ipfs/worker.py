@@ -0,0 +1,331 @@
+from gevent import monkey; monkey.patch_all()
+
+from ipfs.client import IPFSClient
+from ipfs.uploader import IPFSUploader
+from ipfs.indexpublisher import ZipNumIndexPublisher, CDXJIndexPublisher
+
+from pywb_liverec.redisindexer import RedisIndexer
+from pywb_liverec.bloom import RedisBloomFilter
+
+from redis import StrictRedis
+from redis.exceptions import WatchError
+
+from gevent import sleep, spawn
+
+from io import BytesIO
+
+import yaml
+
+import os
+import sys
+import json
+import socket
+import traceback
+
+
+# ============================================================================
+class UploadWorker(object):
+    """ Uploads and indexes records queued in Redis by QueueingUploader.
+
+    Runs concurrency consumers, each moving entries from <key>:pending to
+    its own <key>:processing:<consumer> list (BRPOPLPUSH), up to
+    batch_size at a time. Entries are only removed from there, and their
+    records deleted, once uploaded and indexed. The records of a failed
+    batch are retried one at a time, and failed records are put back on
+    the pending list after backoff secs. A record which has failed more
+    than retries times is moved to the <key>:failed list instead, its
+    record kept for inspection.
+
+    Consumers are registered in <key>:consumers and kept alive by a
+    heartbeat key expiring after heartbeat_ttl secs. The entries of
+    consumers whose heartbeat has expired (eg. in a worker that was
+    killed) are put back on the pending list by the remaining workers.
+
+    The uploader's indexer must write index lines right away (no
+    batch_size), so that they are written before entries are removed.
+    Delivery is at least once: a record may be uploaded and indexed again,
+    which is harmless as its hash, and so its index lines, are the same.
+
+    If an index publisher is given, the index is published to IPFS and
+    IPNS at most once every publish_interval secs across all workers, and
+    by only one worker at a time. If a worker stops while publishing, its
+    lock expires after publish_timeout secs.
+    """
+    def __init__(self, redis, uploader, worker_id=None, key='ipfs:upload',
+                 concurrency=4, batch_size=16, poll_time=5, backoff=1.0,
+                 retries=5, heartbeat_ttl=30, publisher=None, publish_interval=30,
+                 publish_timeout=3600):
+        self.redis = redis
+        self.uploader = uploader
+        self.worker_id = worker_id or '{0}-{1}'.format(socket.gethostname(),
+                                                       os.getpid())
+
+        self.key = key
+        self.pending_key = key + ':pending'
+        self.failed_key = key + ':failed'
+        self.consumers_key = key + ':consumers'
+
+        self.consumers = [self.worker_id + '-' + str(i)
+                          for i in range(concurrency)]
+
+        self.batch_size = batch_size
+        self.poll_time = poll_time
+        self.backoff = backoff
+        self.retries = retries
+        self.heartbeat_ttl = heartbeat_ttl
+
+        self.publisher = publisher
+        self.publish_interval = publish_interval
+        self.publish_timeout = publish_timeout
+        self.publish_lock_key = key + ':publish:lock'
+        self.publish_next_key = key + ':publish:next'
+
+        self.counters = dict(uploaded=0, failed=0, requeued=0, dead=0)
+
+    def run(self):
+        self.heartbeat()
+        self.requeue_dead()
+
+        for consumer in self.consumers:
+            spawn(self._consume, consumer)
+
+        while True:
+            sleep(self.heartbeat_ttl / 3.0)
+
+            try:
+                self.heartbeat()
+                self.requeue_dead()
+                if self.publisher:
+                    self.publish_index()
+            except Exception:
+                traceback.print_exc()
+
+    def heartbeat(self):
+        pipe = self.redis.pipeline()
+        for consumer in self.consumers:
+            pipe.sadd(self.consumers_key, consumer)
+            pipe.set(self._alive_key(consumer), 1, ex=self.heartbeat_ttl)
+        pipe.execute()
+
+    def requeue_dead(self):
+        """ Put back the entries of consumers no longer alive
+        """
+        for consumer in self.redis.smembers(self.consumers_key):
+            if self.redis.exists(self._alive_key(consumer)):
+                continue
+
+            processing = self._processing_key(consumer)
+            while self.redis.rpoplpush(processing, self.pending_key):
+                self.counters['requeued'] += 1
+
+            self.redis.srem(self.consumers_key, consumer)
+
+    def publish_index(self):
+        # held for the whole publish: publishers share the pending changes
+        # and shards, so must not overlap, however long a publish takes
+        if not self.redis.set(self.publish_lock_key, self.worker_id,
+                              ex=self.publish_timeout, nx=True):
+            return
+
+        try:
+            # expires after publish_interval, limiting publishing
+            # to once per interval, by whichever worker gets it first
+            if not self.redis.set(self.publish_next_key, self.worker_id,
+                                  ex=self.publish_interval, nx=True):
+                return
+
+            res = self.publisher.publish()
+            if not res:
+                return
+
+            print('Updating Index: ' + res)
+            print(self.uploader.api.name_publish(res))
+
+        finally:
+            self._release_publish_lock()
+
+    def _release_publish_lock(self):
+        """ Delete the lock, unless it expired and was taken by another worker
+        """
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(self.publish_lock_key)
+                if pipe.get(self.publish_lock_key) == self.worker_id:
+                    pipe.multi()
+                    pipe.delete(self.publish_lock_key)
+                    pipe.execute()
+
+            except WatchError:
+                pass
+
+    def _consume(self, consumer):
+        processing = self._processing_key(consumer)
+
+        # entries left from a previous run with the same id
+        while self.redis.rpoplpush(processing, self.pending_key):
+            self.counters['requeued'] += 1
+
+        while True:
+            try:
+                entries = self._fetch(processing)
+                if entries:
+                    self._process(processing, entries)
+
+            except Exception:
+                traceback.print_exc()
+                sleep(self.backoff)
+
+    def _fetch(self, processing):
+        entry = self.redis.brpoplpush(self.pending_key, processing,
+                                      timeout=self.poll_time)
+        if not entry:
+            return []
+
+        entries = [entry]
+        while len(entries) < self.batch_size:
+            entry = self.redis.rpoplpush(self.pending_key, processing)
+            if not entry:
+                break
+
+            entries.append(entry)
+
+        return entries
+
+    def _process(self, processing, entries):
+        infos = [json.loads(entry) for entry in entries]
+        buffs = self.redis.mget([self._record_key(info['id']) for info in infos])
+
+        # records already done by another consumer, after being requeued
+        batch = []
+        for info, buff in zip(infos, buffs):
+            if buff is not None:
+                batch.append((BytesIO(buff), info['name'], info['split']))
+
+        try:
+            if batch:
+                self.uploader.upload_batch(batch)
+
+        except Exception:
+            traceback.print_exc()
+
+            # so that one bad record does not fail the others again
+            if len(batch) > 1:
+                for entry in entries:
+                    self._process(processing, [entry])
+                return
+
+            self.counters['failed'] += len(batch)
+            sleep(self.backoff)
+            self._retry(processing, entries)
+            return
+
+        pipe = self.redis.pipeline()
+        for info, entry in zip(infos, entries):
+            pipe.lrem(processing, 1, entry)
+            pipe.delete(self._record_key(info['id']))
+        pipe.execute()
+
+        self.counters['uploaded'] += len(batch)
+
+    def _retry(self, processing, entries):
+        """ Put failed entries back on the pending list, with their attempt
+        count, or on the failed list once out of retries
+        """
+        pipe = self.redis.pipeline()
+        for entry in entries:
+            info = json.loads(entry)
+            info['attempts'] = info.get('attempts', 0) + 1
+
+            pipe.lrem(processing, 1, entry)
+            if info['attempts'] > self.retries:
+                print('IPFS ADD FAILED: ' + self._record_key(info['id']))
+                pipe.lpush(self.failed_key, json.dumps(info))
+                self.counters['dead'] += 1
+            else:
+                # to the back of the queue, after any other pending entries
+                pipe.lpush(self.pending_key, json.dumps(info))
+                self.counters['requeued'] += 1
+
+        pipe.execute()
+
+    def _processing_key(self, consumer):
+        return self.key + ':processing:' + consumer
+
+    def _alive_key(self, consumer):
+        return self.key + ':alive:' + consumer
+
+    def _record_key(self, id_):
+        return self.key + ':record:' + id_
+
+
+# ============================================================================
+class SettingsLoader(yaml.SafeLoader):
+    """ Loads the settings in config.yaml, skipping the python objects
+    (eg. the recorder classes) which can only be created under uwsgi
+    """
+
+
+SettingsLoader.add_multi_constructor('tag:yaml.org,2002:python/',
+                                     lambda loader, suffix, node: None)
+
+
+def main():
+    """ python -m ipfs.worker [worker id]
+    """
+    with open('./config.yaml') as fh:
+        config = yaml.load(fh, Loader=SettingsLoader)
+
+    api = IPFSClient(config.get('ipfs_host', 'localhost'),
+                     config.get('ipfs_port', 5001),
+                     pool_size=config.get('ipfs_pool_size', 100),
+                     timeout=(config.get('ipfs_connect_timeout', 5),
+                              config.get('ipfs_read_timeout', 120)))
+
+    redis = StrictRedis.from_url(config.get('redis_url'))
+
+    if config.get('index_format', 'zipnum') == 'cdxj':
+        publisher = CDXJIndexPublisher(api, redis, 'ipfs:cdxj',
+                                       page_size=config.get('index_lines_per_block', 3000))
+    else:
+        publisher = ZipNumIndexPublisher(api, redis, 'ipfs:cdxj',
+                                         lines_per_block=config.get('index_lines_per_block', 3000),
+                                         blocks_per_shard=config.get('index_blocks_per_shard', 100))
+
+    # digests indexed here must be added to the bloom filter
+    # checked by the recording processes
+    if config.get('dedup') and config.get('dedup_bloom_capacity'):
+        bloom = RedisBloomFilter(redis, 'ipfs:cdxj:dedup:bloom',
+                                 config.get('dedup_bloom_capacity'),
+                                 error_rate=config.get('dedup_bloom_error_rate', 0.001),
+                                 refresh_interval=config.get('dedup_bloom_refresh', 60))
+    else:
+        bloom = None
+
+    # not batched, so that index lines are written before
+    # the records are removed from the queue
+    indexer = RedisIndexer(redis, 'ipfs:cdxj',
+                           changes_key=publisher.changes_key,
+                           dedup_key='ipfs:cdxj:dedup',
+                           bloom=bloom,
+                           log_ttl=config.get('index_log_ttl', 0))
+
+    if bloom:
+        indexer.seed_bloom()
+
+    uploader = IPFSUploader(api, indexer, config.get('tmp_rec_dir', '/tmp/rec'))
+
+    worker = UploadWorker(redis, uploader,
+                          worker_id=sys.argv[1] if len(sys.argv) > 1 else None,
+                          concurrency=config.get('upload_concurrency', 4),
+                          batch_size=config.get('upload_batch_size', 1),
+                          backoff=config.get('upload_backoff', 1.0),
+                          retries=config.get('upload_retries', 5),
+                          heartbeat_ttl=config.get('worker_heartbeat_ttl', 30),
+                          publisher=publisher,
+                          publish_interval=config.get('index_publish_interval', 30),
+                          publish_timeout=config.get('index_publish_timeout', 3600))
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import math
+import struct
+import hashlib
+
+
+# ============================================================================
+class BloomFilter(object):
+    """ Bloom filter sized for capacity keys at the given false positive rate.
+
+    Bits are numbered as by Redis SETBIT (bit 0 is the high bit of the
+    first byte), so the bit array can be shared as a Redis string.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                      (math.log(2) ** 2)))
+
+        self.num_hashes = max(1, int(round(float(self.num_bits) / capacity *
+                                           math.log(2))))
+
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def get_positions(self, key):
+        # double hashing from a single sha1
+        h1, h2 = struct.unpack('>QQ', hashlib.sha1(key).digest()[:16])
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        positions = self.get_positions(key)
+        for pos in positions:
+            self.bits[pos >> 3] |= 0x80 >> (pos & 7)
+
+        return positions
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self.get_positions(key):
+            if not bits[pos >> 3] & (0x80 >> (pos & 7)):
+                return False
+
+        return True
+
+
+# ============================================================================
+class RedisBloomFilter(BloomFilter):
+    """ Bloom filter shared through a Redis string.
+
+    Keys added with write() are set in Redis as well as locally, and the
+    local copy is replaced with the Redis snapshot by refresh(), to be
+    called every refresh_interval secs, picking up keys added by other
+    processes.
+
+    Keys which existed before the filter are added once with seed().
+    Until then, the filter is not 'seeded' and may be missing keys.
+    """
+    def __init__(self, redis, key, capacity, error_rate=0.001,
+                 refresh_interval=60):
+        super(RedisBloomFilter, self).__init__(capacity, error_rate)
+        self.redis = redis
+        self.key = key
+        self.seeded_key = key + ':seeded'
+        self.refresh_interval = refresh_interval
+        self.seeded = False
+
+    def write(self, pipe, key):
+        """ Add key locally, and set its bits in Redis with pipe
+        """
+        for pos in self.add(key):
+            pipe.setbit(self.key, pos, 1)
+
+    def seed(self, keys):
+        """ Add keys locally, then merge the local bits into Redis in
+        one step, keeping any bits already set there with write()
+        """
+        for key in keys:
+            self.add(key)
+
+        tmp_key = self.key + ':seed'
+
+        pipe = self.redis.pipeline()
+        pipe.set(tmp_key, str(self.bits))
+        pipe.bitop('OR', self.key, self.key, tmp_key)
+        pipe.delete(tmp_key)
+        pipe.set(self.seeded_key, 1)
+        pipe.execute()
+
+        self.seeded = True
+
+    def refresh(self):
+        """ Replace the local bits with the Redis snapshot.
+        Keys added locally but not yet written to Redis must be re-added.
+        """
+        pipe = self.redis.pipeline()
+        pipe.get(self.key)
+        pipe.exists(self.seeded_key)
+        buff, self.seeded = pipe.execute()
+
+        buff = buff or ''
+        bits = bytearray(buff[:len(self.bits)])
+        # redis only stores up to the highest set bit
+        bits.extend(bytearray(len(self.bits) - len(bits)))
+
+        self.bits = bits
@@ -2,9 +2,10 @@ from __future__ import absolute_import
 
 from pywb.rewrite.rewrite_live import LiveRewriter
 
-from pywb_liverec.liverec import request, ReadFullyStream, orig_requests
+from pywb_liverec.liverec import request, create_session, ReadFullyStream, orig_requests
 from pywb_liverec.warcrecorder import SingleFileWARCRecorder
 from pywb_liverec.redisindexer import RedisIndexer
+from pywb_liverec.rollingwriter import RollingWARCWriter
 
 from redis import StrictRedis
 
@@ -12,11 +13,15 @@ from io import BytesIO
 
 indexer = RedisIndexer(StrictRedis(), 'warc:cdxj')
 
+# records are indexed as soon as written, so the current file
+# is written under its final name, to be replayable right away
+warc_writer = RollingWARCWriter('./records', prefix='record-', open_ext='')
+
 
 #=================================================================
 class WARCRecFactory(object):
     def __call__(self):
-        return SingleFileWARCRecorder('./record.warc.gz', indexer)
+        return SingleFileWARCRecorder(warc_writer, indexer)
 
 
 #=================================================================
@@ -24,11 +29,18 @@ class LiveRecordRewriter(LiveRewriter):
     def __init__(self, *args, **kwargs):
         super(LiveRecordRewriter, self).__init__(*args, **kwargs)
 
+        # shared, so that upstream connections are reused across requests
+        self.session = create_session()
+
         def live_rec(*args, **kwargs):
-            return request(recorder_maker=self._get_recorder_factory(), *args, **kwargs)
+            return request(recorder_maker=self._get_recorder_factory(),
+                           session=self.session, *args, **kwargs)
 
         self.live_request = live_rec
 
+        # RecordLimits for draining responses, if set
+        self.limits = None
+
     def is_recording(self):
         return True
 
@@ -37,7 +49,7 @@ class LiveRecordRewriter(LiveRewriter):
 
     def fetch_http(self, *args, **kwargs):
         status_headers, stream = super(LiveRecordRewriter, self).fetch_http(*args, **kwargs)
-        stream = ReadFullyStream(stream)
+        stream = ReadFullyStream(stream, self.limits)
         return status_headers, stream
 
     def add_metadata(self, url, headers, content):
@@ -0,0 +1,215 @@
+from pywb.cdx.cdxsource import RedisCDXSource
+
+from array import array
+from bisect import bisect_left
+
+import heapq
+import time
+import threading
+import traceback
+
+
+# ============================================================================
+class RedisMirrorCDXSource(RedisCDXSource):
+    """ Serves lookups from an in-process copy of a Redis CDXJ sorted set,
+    eg. 'redis://localhost/0/ipfs:cdxj'
+
+    On first use, a background sync is started, which loads the copy in
+    full, then keeps it up to date from the change log written by
+    RedisIndexer (see its log_ttl) every sync_interval secs. If the copy
+    falls further behind than the log goes back, it is reloaded in full.
+    Until a copy is loaded (or if loading fails), lookups go to Redis.
+
+    log_ttl must match the RedisIndexer writing the index.
+    """
+    def __init__(self, redis_url, config=None, sync_interval=1.0,
+                 log_ttl=3600, grace=5, page_size=10000, max_delta=10000,
+                 delta_ratio=0.05):
+        super(RedisMirrorCDXSource, self).__init__(redis_url, config)
+        self.log_key = self.cdx_key + ':log'
+
+        self.sync_interval = sync_interval
+        self.log_ttl = log_ttl
+        # log entries may become visible up to grace secs after
+        # their timestamp, so each sync re-reads the last grace secs
+        self.grace = grace
+
+        self.page_size = page_size
+        self.max_delta = max_delta
+        self.delta_ratio = delta_ratio
+
+        self.lines = None
+        self.last_sync = 0
+        self.syncer = None
+        self.lock = threading.Lock()
+
+        self.counters = dict(lookups=0, fallbacks=0, syncs=0, reloads=0, added=0)
+
+    def load_cdx(self, query):
+        if not self.syncer:
+            self._start_sync()
+
+        lines = self.lines
+        if lines is None:
+            self.counters['fallbacks'] += 1
+            return super(RedisMirrorCDXSource, self).load_cdx(query)
+
+        self.counters['lookups'] += 1
+        return lines.iter_range(query.key, query.end_key)
+
+    def _start_sync(self):
+        with self.lock:
+            if not self.syncer:
+                self.syncer = threading.Thread(target=self._sync_loop)
+                self.syncer.daemon = True
+                self.syncer.start()
+
+    def _sync_loop(self):
+        while True:
+            try:
+                self._sync()
+            except Exception:
+                traceback.print_exc()
+
+            time.sleep(self.sync_interval)
+
+    def _sync(self):
+        start = time.time()
+
+        if self.lines is None or start - self.last_sync > self.log_ttl - self.grace:
+            self._reload()
+            return
+
+        entries = self.redis.zrangebyscore(self.log_key,
+                                           self.last_sync - self.grace,
+                                           '+inf')
+        for entry in entries:
+            for line in entry.split('\n'):
+                if self.lines.add(line):
+                    self.counters['added'] += 1
+
+        self.last_sync = start
+        self.counters['syncs'] += 1
+
+    def _reload(self):
+        start = time.time()
+
+        lines = SortedLines(self.max_delta, self.delta_ratio)
+        lines.load(self._iter_index())
+
+        self.lines = lines
+        # anything added during the load is picked up from the log
+        self.last_sync = start
+        self.counters['reloads'] += 1
+
+    def _iter_index(self):
+        min_ = '-'
+        while True:
+            lines = self.redis.zrangebylex(self.cdx_key, min_, '+',
+                                           start=0, num=self.page_size)
+            if not lines:
+                break
+
+            for line in lines:
+                yield line
+
+            min_ = '(' + lines[-1]
+
+
+# ============================================================================
+class SortedLines(object):
+    """ Sorted set of lines, mostly packed into one string indexed by an
+    array of line offsets. New lines are kept in a small sorted list,
+    merged into the packed lines once there are more than max_delta, or
+    than delta_ratio of the packed lines if more, so that the cost of
+    merges stays in proportion to the lines added.
+
+    Lines are only added by one thread (the sync), while any number
+    may iterate over a range.
+    """
+    YIELD_LINES = 10000
+
+    def __init__(self, max_delta=10000, delta_ratio=0.05):
+        self.max_delta = max_delta
+        self.delta_ratio = delta_ratio
+        # (packed lines, offsets of each line and of the end),
+        # replaced as a whole on merge
+        self.base = ('', array('L', [0]))
+        self.delta = []
+
+    def __len__(self):
+        return len(self.base[1]) - 1 + len(self.delta)
+
+    def load(self, lines):
+        """ Replace contents with lines, which must be sorted
+        """
+        buffs = []
+        offsets = array('L', [0])
+        offset = 0
+
+        for i, line in enumerate(lines):
+            buffs.append(line)
+            offset += len(line)
+            offsets.append(offset)
+
+            # with gevent, let lookups run during a long load or merge
+            if i % self.YIELD_LINES == self.YIELD_LINES - 1:
+                time.sleep(0)
+
+        self.base, self.delta = (''.join(buffs), offsets), []
+
+    def add(self, line):
+        """ Add line, returning False if already present
+        """
+        base = self.base
+        i = self._bisect(base, line)
+        if i < len(base[1]) - 1 and self._line(base, i) == line:
+            return False
+
+        j = bisect_left(self.delta, line)
+        if j < len(self.delta) and self.delta[j] == line:
+            return False
+
+        self.delta.insert(j, line)
+
+        if len(self.delta) > max(self.max_delta, (len(base[1]) - 1) * self.delta_ratio):
+            self.load(heapq.merge(self._iter_base(base, 0, None), self.delta))
+
+        return True
+
+    def iter_range(self, start, end):
+        """ Iterate over lines in [start, end)
+        """
+        base = self.base
+        i = self._bisect(base, start)
+
+        delta = self.delta
+        lo = bisect_left(delta, start)
+        hi = bisect_left(delta, end) if end else len(delta)
+
+        return heapq.merge(self._iter_base(base, i, end), delta[lo:hi])
+
+    def _iter_base(self, base, i, end):
+        for i in xrange(i, len(base[1]) - 1):
+            line = self._line(base, i)
+            if end and line >= end:
+                break
+
+            yield line
+
+    @staticmethod
+    def _line(base, i):
+        buff, offsets = base
+        return buff[offsets[i]:offsets[i + 1]]
+
+    def _bisect(self, base, key):
+        lo = 0
+        hi = len(base[1]) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._line(base, mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
@@ -5,19 +5,32 @@ try:
 except ImportError:
     import http.client as httplib
 
+try:
+    import cookielib
+except ImportError:
+    import http.cookiejar as cookielib
+
 
 orig_connection = httplib.HTTPConnection
 
 from contextlib import contextmanager
 
 import ssl
+import threading
 from array import array
 
-from time import sleep
+from time import sleep, time
+
+from gevent import Timeout
 
 
 BUFF_SIZE = 8192
 
+# recorder maker for the current request, set by record_requests().
+# with gevent monkey patching, this is greenlet-local, so each
+# concurrent request records with its own recorder
+_local = threading.local()
+
 
 # ============================================================================
 class RecordingStream(object):
@@ -57,27 +70,54 @@ class RecordingStream(object):
 class RecordingHTTPResponse(httplib.HTTPResponse):
     def __init__(self, recorder, *args, **kwargs):
         httplib.HTTPResponse.__init__(self, *args, **kwargs)
+        self.recorder = recorder
         self.fp = RecordingStream(self.fp, recorder)
 
     def mark_incomplete(self):
         self.fp.incomplete = True
 
+    def mark_truncated(self, reason):
+        if not self.recorder.truncated:
+            self.recorder.truncated = reason
+
+    def is_truncated(self):
+        return self.recorder.truncated
+
 
 # ============================================================================
 class RecordingHTTPConnection(httplib.HTTPConnection):
-    global_recorder_maker = None
-
+    """ A new recorder is created for each request/response exchange,
+    so a pooled keep-alive connection may be reused by many requests,
+    each recorded separately
+    """
     def __init__(self, *args, **kwargs):
         orig_connection.__init__(self, *args, **kwargs)
-        if not self.global_recorder_maker:
-            self.recorder = None
+        self.recorder = None
+        self.response_class = self._make_response
+
+    def putrequest(self, *args, **kwargs):
+        recorder_maker = getattr(_local, 'recorder_maker', None)
+        if recorder_maker:
+            self.recorder = recorder_maker()
         else:
-            self.recorder = self.global_recorder_maker()
+            self.recorder = None
 
-            def make_recording_response(*args, **kwargs):
-                return RecordingHTTPResponse(self.recorder, *args, **kwargs)
+        return orig_connection.putrequest(self, *args, **kwargs)
 
-            self.response_class = make_recording_response
+    def _make_response(self, *args, **kwargs):
+        if not self.recorder:
+            return httplib.HTTPResponse(*args, **kwargs)
+
+        return RecordingHTTPResponse(self.recorder, *args, **kwargs)
+
+    def _tunnel(self):
+        # don't record the proxy CONNECT exchange
+        recorder = self.recorder
+        self.recorder = None
+        try:
+            orig_connection._tunnel(self)
+        finally:
+            self.recorder = recorder
 
     def send(self, data):
         if not self.recorder:
@@ -140,6 +180,7 @@ class EchoRecorder(object):
         self.request = self._create_buffer()
         self.response = self._create_buffer()
         self.url = None
+        self.truncated = None
 
     def has_url(self):
         return self.url is not None
@@ -170,10 +211,30 @@ class EchoRecorder(object):
         print(self.counters)
 
 
+# ============================================================================
+class RecordLimits(object):
+    """ Limits on recording a response: records are truncated past
+    max_size bytes, and on close, the rest of the response is read for
+    at most max_drain_time secs, at up to max_drain_rate bytes/sec.
+    """
+    def __init__(self, max_size=None, max_drain_time=None, max_drain_rate=None):
+        self.max_size = max_size
+        self.max_drain_time = max_drain_time
+        self.max_drain_rate = max_drain_rate
+
+        self.counters = dict(truncated_length=0, truncated_time=0)
+
+
 #=================================================================
 class ReadFullyStream(object):
-    def __init__(self, stream):
+    """ Reads the rest of the response on close, so that it is recorded
+    in full even if the client stops reading, subject to limits if set.
+    Once a limit is reached, the record is written with what has
+    been read so far, marked with WARC-Truncated.
+    """
+    def __init__(self, stream, limits=None):
         self.stream = stream
+        self.limits = limits
 
     def read(self, length=None):
         try:
@@ -189,24 +250,65 @@ class ReadFullyStream(object):
             self.mark_incomplete()
             raise
 
+    def _get_recording_response(self):
+        fp = getattr(self.stream, '_fp', None)
+        if hasattr(fp, 'mark_incomplete'):
+            return fp
+
+        return None
+
     def mark_incomplete(self):
-        if (hasattr(self.stream, '_fp') and
-            hasattr(self.stream._fp, 'mark_incomplete')):
-            self.stream._fp.mark_incomplete()
+        fp = self._get_recording_response()
+        if fp:
+            fp.mark_incomplete()
 
     def close(self):
+        limits = self.limits
+        fp = self._get_recording_response()
+        start = time()
+        total = 0
+
+        # also interrupts a read from an upstream which has stalled
+        timeout = Timeout((limits and limits.max_drain_time) or None)
+        timeout.start()
+
         try:
             while True:
+                # nothing more will be recorded
+                if fp and fp.is_truncated():
+                    break
+
                 buff = self.stream.read(BUFF_SIZE)
-                sleep(0)
                 if not buff:
                     break
 
+                if not limits:
+                    sleep(0)
+                    continue
+
+                total += len(buff)
+
+                # throttle to max_drain_rate
+                if limits.max_drain_rate:
+                    elapsed = time() - start
+                    sleep(max(0, float(total) / limits.max_drain_rate - elapsed))
+                else:
+                    sleep(0)
+
+        except Timeout as t:
+            if t is not timeout:
+                raise
+
+            if fp:
+                fp.mark_truncated('time')
+                limits.counters['truncated_time'] += 1
+
         except Exception as e:
             import traceback
             traceback.print_exc(e)
             self.mark_incomplete()
         finally:
+            timeout.cancel()
             self.stream.close()
 
 
@@ -222,19 +324,44 @@ class DefaultRecorderMaker(object):
 
 @contextmanager
 def record_requests(url, recorder_maker):
-    RecordingHTTPConnection.global_recorder_maker = recorder_maker
-    yield
-    RecordingHTTPConnection.global_recorder_maker = None
+    prev = getattr(_local, 'recorder_maker', None)
+    _local.recorder_maker = recorder_maker
+    try:
+        yield
+    finally:
+        _local.recorder_maker = prev
 
 @contextmanager
 def orig_requests():
-    httplib.HTTPConnection = orig_connection
-    yield
-    httplib.HTTPConnection = RecordingHTTPConnection
+    # only for the current request: connections made by other
+    # requests in the meantime are still recorded
+    with record_requests(None, None):
+        yield
 
 
 import requests as patched_requests
 
+
+class BlockAllCookies(cookielib.DefaultCookiePolicy):
+    return_ok = set_ok = domain_return_ok = path_return_ok = \
+        lambda self, *args, **kwargs: False
+
+
+def create_session(pool_size=100):
+    """ Session for live requests, pooling keep-alive connections to
+    each host across requests. As the session is shared by all users,
+    it never stores cookies, only sends those in each request's headers
+    """
+    session = patched_requests.Session()
+    session.cookies.set_policy(BlockAllCookies())
+
+    adapter = patched_requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                    pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 def request(url, method='GET', recorder_maker=None, session=patched_requests, **kwargs):
     if kwargs.get('skip_recording'):
         recorder_maker = None
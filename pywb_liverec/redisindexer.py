@@ -5,10 +5,56 @@ from pywb.utils.timeutils import timestamp_to_datetime
 
 from io import BytesIO
 
+import atexit
+import threading
+import time
+import traceback
+
+
 class RedisIndexer(object):
-    def __init__(self, redis, key):
+    # max lines per ZADD command
+    MAX_ZADD = 500
+
+    # sha1 of an empty payload (eg. of a redirect or a 204), which is not
+    # deduplicated by digest alone, as any such response would match it
+    EMPTY_DIGEST = '3I42H3S6NNFQ2MSVX7XZKYAYSCX5QBYJ'
+
+    def __init__(self, redis, key, changes_key=None, dedup_key=None,
+                 bloom=None, batch_size=0, batch_time=1.0, log_ttl=0):
         self.redis = redis
         self.key = key
+        # if set, also add each new line to this set
+        self.changes_key = changes_key
+
+        # if set, also log each write of new lines in the sorted set
+        # key + ':log', scored by time and kept for log_ttl secs,
+        # for incremental sync by RedisMirrorCDXSource
+        self.log_ttl = log_ttl
+        self.log_key = key + ':log'
+
+        # if set, map each payload digest to its first capture in this hash,
+        # for constant time dedup lookups
+        self.dedup_key = dedup_key
+        self.pending_dedup = {}
+
+        # if set, a RedisBloomFilter of the digests in the dedup hash,
+        # so that lookups for new digests can skip redis. It is refreshed
+        # in the background once lookups start
+        self.bloom = bloom
+        self.bloom_refresher = None
+        self.counters = dict(dedup_lookups=0, dedup_avoided=0)
+
+        # if batch_size is set, lines from all records are written together
+        # once batch_size lines are pending, or batch_time secs after the
+        # first pending line, whichever is first
+        self.batch_size = batch_size
+        self.batch_time = batch_time
+        self.pending = []
+        self.lock = threading.Lock()
+        self.timer = None
+
+        if batch_size:
+            atexit.register(self.flush)
 
     def add_record(self, stream, name=None):
         stream.seek(0)
@@ -19,14 +65,110 @@ class RedisIndexer(object):
         write_cdx_index(cdxout, stream, name,
                         cdxj=True, append_post=True)
 
-        cdxes = cdxout.getvalue()
-        for cdx in cdxes.split('\n'):
-            if cdx:
-                self.redis.zadd(self.key, 0, cdx)
+        cdxes = [cdx for cdx in cdxout.getvalue().split('\n') if cdx]
+
+        if self.dedup_key:
+            dedup = self._get_dedup_entries(cdxes)
+        else:
+            dedup = {}
+
+        if not self.batch_size:
+            self._write(cdxes, dedup)
+            return cdxes
+
+        with self.lock:
+            self.pending.extend(cdxes)
+            for digest, capture in dedup.items():
+                self.pending_dedup.setdefault(digest, capture)
+                if self.bloom:
+                    self.bloom.add(digest)
+
+            full = len(self.pending) >= self.batch_size
+
+            if not full and not self.timer:
+                self.timer = threading.Timer(self.batch_time, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if full:
+            self.flush()
+
+        return cdxes
+
+    def flush(self):
+        """ Write all pending lines now
+        """
+        with self.lock:
+            cdxes = self.pending
+            self.pending = []
+            pending_dedup = self.pending_dedup
+            self.pending_dedup = {}
+
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+        if not cdxes:
+            return
+
+        try:
+            self._write(cdxes, pending_dedup)
+        except:
+            # keep for the next flush
+            with self.lock:
+                self.pending = cdxes + self.pending
+                pending_dedup.update(self.pending_dedup)
+                self.pending_dedup = pending_dedup
+            raise
+
+    def _write(self, cdxes, dedup):
+        if not cdxes:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
 
-        return cdx
+        for i in range(0, len(cdxes), self.MAX_ZADD):
+            chunk = cdxes[i:i + self.MAX_ZADD]
+
+            args = []
+            for cdx in chunk:
+                args.extend((0, cdx))
+
+            pipe.zadd(self.key, *args)
+            if self.changes_key:
+                pipe.sadd(self.changes_key, *chunk)
+
+        if self.log_ttl:
+            now = time.time()
+            pipe.zadd(self.log_key, now, '\n'.join(cdxes))
+            pipe.zremrangebyscore(self.log_key, '-inf', now - self.log_ttl)
+
+        for digest, capture in dedup.items():
+            pipe.hsetnx(self.dedup_key, digest, capture)
+            if self.bloom:
+                self.bloom.write(pipe, digest)
+
+        pipe.execute()
+
+    def _get_dedup_entries(self, cdxes):
+        """ Return digest -> '<timestamp> <url>' of the first capture
+        of each payload in cdxes, skipping revisits and empty payloads
+        """
+        dedup = {}
+        for cdx in cdxes:
+            cdx = CDXObject(cdx)
+            digest = cdx.get('digest', '-')
+            if digest in ('-', self.EMPTY_DIGEST) or cdx.get('mime') == 'warc/revisit':
+                continue
+
+            dedup.setdefault(digest, cdx['timestamp'] + ' ' + cdx['url'])
+
+        return dedup
 
     def lookup(self, digest, url, timestamp):
+        if self.dedup_key:
+            return self._lookup_digest(digest)
+
         start, end = calc_search_range(url, 'exact')
         results = self.redis.zrangebylex(self.key, '[' + start, '(' + end)
         for res in results:
@@ -36,3 +178,69 @@ class RedisIndexer(object):
 
         return None
 
+    def _lookup_digest(self, digest):
+        digest = str(digest).split(':', 1)[-1]
+        if digest == self.EMPTY_DIGEST:
+            return None
+
+        if self.bloom:
+            if not self.bloom_refresher:
+                self._start_bloom_refresh()
+
+            # until seeded, the filter may be missing recorded digests
+            if self.bloom.seeded and digest not in self.bloom:
+                self.counters['dedup_avoided'] += 1
+                return None
+
+        self.counters['dedup_lookups'] += 1
+
+        capture = self.pending_dedup.get(digest)
+        if not capture:
+            capture = self.redis.hget(self.dedup_key, digest)
+            if not capture:
+                return None
+
+        timestamp, url = capture.split(' ', 1)
+        return ('revisit', url, timestamp_to_datetime(timestamp))
+
+    def seed_bloom(self, lock_ttl=600):
+        """ Add the digests already in the dedup hash to the bloom filter,
+        unless done before. Reads the whole hash, so is run on startup,
+        by only one process at a time, rather than from a lookup.
+        """
+        self.bloom.refresh()
+        if self.bloom.seeded:
+            return
+
+        if not self.redis.set(self.bloom.key + ':seeding', 1,
+                              ex=lock_ttl, nx=True):
+            return
+
+        self.bloom.seed(digest for digest, _ in
+                        self.redis.hscan_iter(self.dedup_key))
+
+    def _start_bloom_refresh(self):
+        with self.lock:
+            if not self.bloom_refresher:
+                self.bloom_refresher = threading.Thread(target=self._bloom_refresh_loop)
+                self.bloom_refresher.daemon = True
+                self.bloom_refresher.start()
+
+    def _bloom_refresh_loop(self):
+        while True:
+            time.sleep(self.bloom.refresh_interval)
+
+            try:
+                self._refresh_bloom()
+            except Exception:
+                traceback.print_exc()
+
+    def _refresh_bloom(self):
+        self.bloom.refresh()
+
+        # digests not yet written to redis. A digest in a batch being
+        # written right now may be missed, which only means that a full
+        # response is recorded instead of a revisit
+        with self.lock:
+            for digest in self.pending_dedup:
+                self.bloom.add(digest)
@@ -0,0 +1,315 @@
+import os
+import zlib
+import time
+import uuid
+import threading
+import traceback
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+
+# ============================================================================
+class RollingWARCWriter(object):
+    """ Appends WARC records from many recorders to a shared file,
+    closing it and starting a new one once it grows past max_size bytes
+    or has been open for max_age seconds.
+
+    Each recorder serializes its records into its own buffer and passes
+    it to write_record(). A single writer thread owns the open file and
+    appends queued buffers in order, so records are never interleaved
+    and no lock is held while they are compressed. If fsync is set, the
+    file is synced once for each batch of records written together,
+    before write_record() returns.
+
+    The current file is written as <name>.warc.gz + open_ext and renamed
+    to <name>.warc.gz when closed, then passed to on_close(filename).
+    Files left open by a previous run are closed by recover().
+    """
+    EXT = '.warc.gz'
+    BUFF_SIZE = 64*1024
+
+    def __init__(self, dirname, max_size=100000000, max_age=300,
+                 on_close=None, prefix='rec-', fsync=False,
+                 max_queue=256, max_batch=64, open_ext='.open'):
+        self.dirname = dirname
+        self.open_ext = open_ext
+        self.max_size = max_size
+        self.max_age = max_age
+        self.on_close = on_close
+        self.prefix = prefix
+        self.fsync = fsync
+        self.max_batch = max_batch
+
+        self.queue = Queue(maxsize=max_queue)
+        self.writer = None
+        self.start_lock = threading.Lock()
+
+        # only used by the writer thread
+        self.out = None
+        self.filename = None
+        self.opened = None
+
+    def write_record(self, buff):
+        """ Append the serialized record(s) in buff to the current file,
+        returning the (filename, offset) they were written at
+        """
+        entry = WriteEntry(buff)
+        self._put(entry)
+        return entry.wait()
+
+    def close(self):
+        """ Close the current file, if any
+        """
+        if not self.writer:
+            return
+
+        entry = WriteEntry(None)
+        self._put(entry)
+        entry.wait()
+
+    def recover(self):
+        """ Close files left open by a previous run (eg. after a crash),
+        dropping any partly written record at the end. Must be called
+        before any records are written, and the dir must not be shared
+        with another running writer.
+        """
+        if not self.open_ext or not os.path.isdir(self.dirname):
+            return
+
+        for name in sorted(os.listdir(self.dirname)):
+            if not name.startswith(self.prefix) or not name.endswith(self.EXT + self.open_ext):
+                continue
+
+            filename = os.path.join(self.dirname, name[:-len(self.open_ext)])
+            try:
+                end = find_complete_end(filename + self.open_ext)
+                with open(filename + self.open_ext, 'r+b') as fh:
+                    fh.truncate(end)
+
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            print('Recovered: ' + filename)
+            self._finish(filename)
+
+    def _put(self, entry):
+        if not self.writer:
+            with self.start_lock:
+                if not self.writer:
+                    self.writer = threading.Thread(target=self._write_loop)
+                    self.writer.daemon = True
+                    self.writer.start()
+
+        self.queue.put(entry)
+
+    def _write_loop(self):
+        while True:
+            try:
+                entry = self.queue.get(timeout=self._get_timeout())
+            except Empty:
+                self._close_if_expired()
+                continue
+
+            batch = [entry]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                traceback.print_exc()
+                for entry in batch:
+                    entry.fail(e)
+
+            self._close_if_expired()
+
+    def _get_timeout(self):
+        # wake up to close the current file once it expires
+        if not self.out or not self.max_age:
+            return None
+
+        return max(0, self.opened + self.max_age - time.time())
+
+    def _write_batch(self, batch):
+        written = []
+
+        for entry in batch:
+            # close request
+            if entry.buff is None:
+                self._ack(written)
+                written = []
+                if self.out:
+                    self._close()
+                entry.done()
+                continue
+
+            if not self.out:
+                self._open()
+
+            offset = self.out.tell()
+            try:
+                self._copy(entry.buff)
+            except Exception as e:
+                # don't leave a partial record in the file
+                self.out.seek(offset)
+                self.out.truncate()
+                traceback.print_exc()
+                entry.fail(e)
+                continue
+
+            entry.result = (self.filename, offset)
+            written.append(entry)
+
+            if self.out.tell() >= self.max_size:
+                self._ack(written)
+                written = []
+                self._close()
+
+        self._ack(written)
+
+    def _copy(self, buff):
+        buff.seek(0)
+        while True:
+            chunk = buff.read(self.BUFF_SIZE)
+            if not chunk:
+                break
+            self.out.write(chunk)
+
+    def _ack(self, written):
+        """ Flush (and sync) the records just written, then release their writers
+        """
+        if not written:
+            return
+
+        self.out.flush()
+        if self.fsync:
+            os.fsync(self.out.fileno())
+
+        for entry in written:
+            entry.done()
+
+    def _close_if_expired(self):
+        if self.out and self._is_expired():
+            self._close()
+
+    def _is_expired(self):
+        return self.max_age and (time.time() - self.opened) >= self.max_age
+
+    def _open(self):
+        try:
+            os.makedirs(self.dirname)
+        except OSError:
+            pass
+
+        name = self.prefix + time.strftime('%Y%m%d%H%M%S') + '-' + str(uuid.uuid1())
+        self.filename = os.path.join(self.dirname, name + self.EXT)
+        self.out = open(self.filename + self.open_ext, 'wb')
+        self.opened = time.time()
+
+    def _close(self):
+        self.out.flush()
+        if self.fsync:
+            os.fsync(self.out.fileno())
+
+        self.out.close()
+        self.out = None
+
+        self._finish(self.filename)
+
+    def _finish(self, filename):
+        if self.open_ext:
+            os.rename(filename + self.open_ext, filename)
+
+        if self.on_close:
+            try:
+                self.on_close(filename)
+            except Exception:
+                traceback.print_exc()
+
+
+# ============================================================================
+def find_complete_end(filename, buff_size=64*1024):
+    """ Return the length of filename up to the end of its last complete
+    gzip member, or the full length if it is not gzipped
+    """
+    with open(filename, 'rb') as fh:
+        if fh.read(2) != '\x1f\x8b':
+            return os.path.getsize(filename)
+
+        fh.seek(0)
+
+        end = 0
+        pos = 0
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        while True:
+            buff = fh.read(buff_size)
+            if not buff:
+                # input past the end of a complete member is unused
+                decomp.decompress('\x00')
+                return pos if decomp.unused_data else end
+
+            pos += len(buff)
+
+            while buff:
+                decomp.decompress(buff, buff_size)
+                buff = decomp.unconsumed_tail
+
+                # the member ended, continue with the next one
+                if decomp.unused_data:
+                    buff = decomp.unused_data + buff
+                    end = pos - len(buff)
+                    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+# ============================================================================
+class WriteEntry(object):
+    def __init__(self, buff):
+        self.buff = buff
+        self.result = None
+        self.error = None
+        self.event = threading.Event()
+
+    def done(self):
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error:
+            raise self.error
+
+        return self.result
+
+
+# ============================================================================
+class OffsetStream(object):
+    """ Wraps a buffer of records written at offset in a WARC, so that
+    indexing the buffer gives the records' offsets in the WARC.
+    Only tell() is shifted by offset, seek() is within the buffer.
+    """
+    def __init__(self, stream, offset):
+        self.stream = stream
+        self.offset = offset
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def readline(self, size=-1):
+        return self.stream.readline(size)
+
+    def tell(self):
+        return self.offset + self.stream.tell()
+
+    def seek(self, *args, **kwargs):
+        return self.stream.seek(*args, **kwargs)
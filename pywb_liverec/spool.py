@@ -0,0 +1,147 @@
+import tempfile
+import threading
+
+from io import BytesIO
+
+
+# ============================================================================
+class SpoolPool(object):
+    """ Creates spools which share a process-wide budget of max_mem bytes.
+
+    A spool is kept in memory until it grows past its own max_size, or
+    until growing it would take the total held in memory by all spools
+    past max_mem, then rolls over to a temp file.
+
+    A spool's memory is returned to the budget when it is closed or rolled
+    over, or once it is garbage collected if never closed (eg. by a
+    recorder whose exchange failed before the response).
+    """
+    def __init__(self, max_mem=64*1024*1024, max_size=512*1024,
+                 tmp_dir=None):
+        self.max_mem = max_mem
+        self.max_size = max_size
+        self.tmp_dir = tmp_dir
+
+        self.mem_used = 0
+        # reentrant: spools may be released by the gc at any allocation,
+        # including one made while the lock is held
+        self.lock = threading.RLock()
+
+        self.counters = dict(created=0, rollovers=0,
+                             budget_rollovers=0, peak_mem=0)
+
+    def create_spool(self, max_size=None):
+        self.counters['created'] += 1
+        return PooledSpool(self, max_size or self.max_size)
+
+    def reserve(self, size):
+        """ Reserve size more bytes of memory, returning False if
+        that would exceed the budget
+        """
+        with self.lock:
+            if self.mem_used + size > self.max_mem:
+                return False
+
+            self.mem_used += size
+            if self.mem_used > self.counters['peak_mem']:
+                self.counters['peak_mem'] = self.mem_used
+
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.mem_used -= size
+
+    def create_file(self):
+        return tempfile.TemporaryFile(dir=self.tmp_dir)
+
+
+# ============================================================================
+class PooledSpool(object):
+    """ File-like spool from a SpoolPool, in memory until rolled over
+    """
+    def __init__(self, pool, max_size):
+        self.pool = pool
+        self.max_size = max_size
+
+        self.file = BytesIO()
+        self.in_mem = True
+        # bytes reserved from the pool for the memory buffer
+        self.reserved = 0
+
+    def write(self, buff):
+        if self.in_mem:
+            end = self.file.tell() + len(buff)
+            grow = end - self.reserved
+
+            if grow > 0:
+                if end > self.max_size:
+                    self.pool.counters['rollovers'] += 1
+                    self.rollover()
+
+                elif not self.pool.reserve(grow):
+                    self.pool.counters['budget_rollovers'] += 1
+                    self.rollover()
+
+                else:
+                    self.reserved = end
+
+        self.file.write(buff)
+
+    def rollover(self):
+        if not self.in_mem:
+            return
+
+        mem = self.file
+        pos = mem.tell()
+
+        self.file = self.pool.create_file()
+        self.file.write(mem.getvalue())
+        self.file.seek(pos)
+
+        self.in_mem = False
+        self._release_mem()
+
+    def _release_mem(self):
+        self.pool.release(self.reserved)
+        self.reserved = 0
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        return self.file.read(size)
+
+    def readinto(self, buff):
+        return self.file.readinto(buff)
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        return self.file.readline(size)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        return self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+
+        if self.in_mem:
+            self._release_mem()
+        else:
+            self.file.close()
+
+        self.file = None
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def closed(self):
+        return self.file is None
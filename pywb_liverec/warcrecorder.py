@@ -6,12 +6,15 @@ import datetime
 import zlib
 import sys
 import os
+import struct
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 from pywb.utils.loaders import LimitReader
 from pywb.utils.bufferedreaders import BufferedReader
 
+from pywb_liverec.rollingwriter import OffsetStream
+
 
 # ============================================================================
 class BaseWARCRecorder(object):
@@ -25,11 +28,25 @@ class BaseWARCRecorder(object):
 
     REVISIT_PROFILE = 'http://netpreserve.org/warc/1.0/revisit/uri-agnostic-identical-payload-digest'
 
-    def __init__(self, gzip=True, dedup=None):
-        self.gzip = True
+    # record bodies are copied through the compressor in chunks of this size
+    BUFF_SIZE = 64*1024
+
+    def __init__(self, gzip=True, dedup=None, compressor=None, policy=None,
+                 spool_pool=None, limits=None):
+        self.gzip = gzip
+
+        # RecordLimits, if set
+        self.limits = limits
+        # if set, the WARC-Truncated reason
+        self.truncated = None
+
+        self.spool_pool = spool_pool
 
         self.dedup = dedup
 
+        self.compressor = compressor or default_compressor
+        self.policy = policy
+
         self.target_ip = None
         self.url = None
         self.finished = False
@@ -50,6 +67,9 @@ class BaseWARCRecorder(object):
         return Digester('sha1')
 
     def _create_buffer(self):
+        if self.spool_pool:
+            return self.spool_pool.create_spool()
+
         return tempfile.SpooledTemporaryFile(max_size=512*1024)
 
     def start_request(self):
@@ -74,9 +94,22 @@ class BaseWARCRecorder(object):
         self.resp_buff.write(buff)
 
     def write_response_buff(self, buff):
+        """ Record a buff of the payload, which
+        is also part of the block
+        """
         if not self.payload_offset:
             self.payload_offset = self.resp_buff.tell()
 
+        if self.limits and self.limits.max_size:
+            if self.truncated:
+                return
+
+            remaining = self.limits.max_size - self.resp_buff.tell()
+            if len(buff) > remaining:
+                self.truncated = 'length'
+                self.limits.counters['truncated_length'] += 1
+                buff = buff[:max(0, remaining)]
+
         self.resp_block_digest.update(buff)
         self.resp_payload_digest.update(buff)
         self.resp_buff.write(buff)
@@ -101,7 +134,8 @@ class BaseWARCRecorder(object):
 
     def _write_warc_response(self, out, dt=None, concur_id=None, warc_id=None):
         dt = dt or self.dt_now
-        if self.dedup:
+        # the payload digest of a truncated record is not of the full payload
+        if self.dedup and not self.truncated:
             try:
                 result = self.dedup.lookup(self.resp_payload_digest,
                                            self.url, dt)
@@ -125,10 +159,26 @@ class BaseWARCRecorder(object):
             ('WARC-IP-Address', self.target_ip),
             ('WARC-Concurrent-To', concur_id),
             ('WARC-Block-Digest', self.resp_block_digest),
-            ('WARC-Payload-Digest', self.resp_payload_digest)
+            ('WARC-Payload-Digest', self.resp_payload_digest),
+            ('WARC-Truncated', self.truncated),
         )
 
-        self._write_warc_record(out, OrderedDict(headers), self.resp_buff)
+        self._write_warc_record(out, OrderedDict(headers), self.resp_buff,
+                                level=self._get_response_level())
+
+    def _get_response_level(self):
+        """ Gzip level for the response from the policy, if any,
+        based on the http headers and the start of the payload
+        """
+        if not self.policy or not self.payload_offset:
+            return None
+
+        self.resp_buff.seek(0)
+        http_headers = self.resp_buff.read(self.payload_offset)
+        sample = self.resp_buff.read(self.policy.sample_size)
+        self.resp_buff.seek(0, 2)
+
+        return self.policy.get_level(http_headers, sample)
 
     def _write_warc_revisit(self, out, dt, orig_url, orig_dt, warc_id=None):
         dt = dt or self.dt_now
@@ -177,9 +227,14 @@ class BaseWARCRecorder(object):
         self._write_warc_record(out, OrderedDict(headers), data,
                                 content_type=content_type)
 
-    def _write_warc_record(self, out, headers, buff, content_type=None, length=None):
+    def _write_warc_record(self, out, headers, buff, content_type=None, length=None,
+                           level=None):
+        if buff and not length:
+            length = buff.tell()
+            buff.seek(0)
+
         if self.gzip:
-            out = GzippingWriter(out)
+            out = self.compressor.create_writer(out, length, level)
 
         self._line(out, 'WARC/1.0')
 
@@ -192,14 +247,14 @@ class BaseWARCRecorder(object):
         self._header(out, 'Content-Type', content_type)
 
         if buff:
-            if not length:
-                length = buff.tell()
-                buff.seek(0)
-
             self._header(out, 'Content-Length', length)
             # add empty line
             self._line(out, '')
-            out.write(buff.read())
+            while True:
+                chunk = buff.read(self.BUFF_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
             # add two lines
             self._line(out, '\r\n')
         else:
@@ -228,10 +283,112 @@ class BaseWARCRecorder(object):
         return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
+# ============================================================================
+class GzipCompressor(object):
+    """ Creates the gzip writer for each record.
+
+    Records of at least parallel_min_size bytes are compressed with
+    ParallelGzippingWriter on a pool of 'threads' threads, if set.
+    """
+    def __init__(self, level=9, threads=0, parallel_min_size=1024*1024,
+                 block_size=128*1024):
+        self.level = level
+        self.parallel_min_size = parallel_min_size
+        self.block_size = block_size
+        self.threads = threads
+        self.pool = None
+
+    def create_writer(self, out, length=None, level=None):
+        if level is None:
+            level = self.level
+
+        # nothing to gain from parallel stored blocks
+        if (self.threads and level and
+            length and length >= self.parallel_min_size):
+            if self.pool is None:
+                self.pool = self._create_pool()
+
+            return ParallelGzippingWriter(out, self.pool, level,
+                                          self.block_size,
+                                          max_pending=self.threads * 2)
+
+        return GzippingWriter(out, level)
+
+    def _create_pool(self):
+        # zlib releases the GIL, so real threads compress in parallel.
+        # if gevent has patched threading, use its pool of real threads
+        try:
+            from gevent.monkey import is_module_patched
+            if is_module_patched('threading'):
+                from gevent.threadpool import ThreadPool
+                return ThreadPool(self.threads)
+        except ImportError:
+            pass
+
+        from multiprocessing.pool import ThreadPool
+        return ThreadPool(self.threads)
+
+
+# ============================================================================
+class CompressionPolicy(object):
+    """ Picks fast_level for responses which are already compressed,
+    by Content-Encoding, by Content-Type, or if a fast compression
+    of the first sample_size bytes of the payload saves less than
+    1 - min_ratio of its size. Others are compressed at the default level.
+
+    Level 0 writes stored deflate blocks, still framed as a gzip member.
+    """
+    COMPRESSED_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp',
+                        'video/', 'audio/',
+                        'font/woff', 'application/font-woff',
+                        'application/zip', 'application/gzip',
+                        'application/x-gzip', 'application/pdf')
+
+    COMPRESSED_ENCODINGS = ('gzip', 'x-gzip', 'br', 'deflate', 'compress', 'zstd')
+
+    def __init__(self, fast_level=0, sample_size=4096, min_ratio=0.9):
+        self.fast_level = fast_level
+        self.sample_size = sample_size
+        self.min_ratio = min_ratio
+
+        self.counters = dict(fast=0, default=0)
+
+    def get_level(self, http_headers, sample):
+        """ Return fast_level or None for the default level
+        """
+        if self._is_compressed(http_headers, sample):
+            self.counters['fast'] += 1
+            return self.fast_level
+
+        self.counters['default'] += 1
+        return None
+
+    def _is_compressed(self, http_headers, sample):
+        for line in http_headers.split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            value = value.strip().lower()
+
+            if name == 'content-encoding':
+                if value in self.COMPRESSED_ENCODINGS:
+                    return True
+
+            elif name == 'content-type':
+                if value.startswith(self.COMPRESSED_TYPES):
+                    return True
+
+        # too little to tell, and too little to matter
+        if len(sample) < 512:
+            return False
+
+        ratio = float(len(zlib.compress(sample, 1))) / len(sample)
+        return ratio >= self.min_ratio
+
+
 # ============================================================================
 class GzippingWriter(object):
-    def __init__(self, out):
-        self.compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS + 16)
+    def __init__(self, out, level=9):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS + 16)
         self.out = out
 
     def write(self, buff):
@@ -246,6 +403,76 @@ class GzippingWriter(object):
         self.out.flush()
 
 
+# ============================================================================
+class ParallelGzippingWriter(object):
+    """ Writes a single gzip member, pigz-style: input is split into
+    block_size blocks, each deflated independently on the pool, and
+    the outputs are joined in order. Up to max_pending blocks may be
+    compressing at once.
+    """
+    GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+    def __init__(self, out, pool, level=6, block_size=128*1024, max_pending=8):
+        self.out = out
+        self.pool = pool
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = max_pending
+
+        self.buffs = []
+        self.buff_len = 0
+        self.pending = deque()
+
+        self.crc = 0
+        self.size = 0
+
+        self.out.write(self.GZIP_HEADER)
+
+    def write(self, buff):
+        self.crc = zlib.crc32(buff, self.crc)
+        self.size += len(buff)
+
+        self.buffs.append(buff)
+        self.buff_len += len(buff)
+
+        if self.buff_len >= self.block_size:
+            self._submit_block(False)
+
+    def _submit_block(self, final):
+        block = ''.join(self.buffs)
+        self.buffs = []
+        self.buff_len = 0
+
+        self.pending.append(self.pool.apply_async(deflate_block,
+                                                  (block, self.level, final)))
+
+        while len(self.pending) > self.max_pending:
+            self.out.write(self.pending.popleft().get())
+
+    def flush(self):
+        self._submit_block(True)
+
+        while self.pending:
+            self.out.write(self.pending.popleft().get())
+
+        self.out.write(struct.pack('<II', self.crc & 0xffffffff,
+                                   self.size & 0xffffffff))
+        self.out.flush()
+
+
+# ============================================================================
+def deflate_block(block, level, final):
+    """ Raw deflate a block independently of any other. A non-final
+    block ends with a sync flush, so blocks can be concatenated
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    buff = compressor.compress(block)
+    if final:
+        return buff + compressor.flush(zlib.Z_FINISH)
+    else:
+        return buff + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
 # ============================================================================
 class Digester(object):
     def __init__(self, type_='sha1'):
@@ -265,37 +492,47 @@ class Digester(object):
         return self.type_ + ':' + str(base64.b32encode(self.digester.digest()))
 
 
+default_compressor = GzipCompressor()
+
+
 # ============================================================================
 class SingleFileWARCRecorder(BaseWARCRecorder):
-    def __init__(self, warcfilename, indexer=None):
-        super(SingleFileWARCRecorder, self).__init__()
-        self.warcfilename = warcfilename
+    """ Appends records to the current file of a shared RollingWARCWriter.
+    Records are indexed from the buffer they were written from, at the
+    offset they were written at, rather than by re-reading the WARC
+    """
+    def __init__(self, warc_writer, indexer=None, **kwargs):
+        super(SingleFileWARCRecorder, self).__init__(**kwargs)
+        self.warc_writer = warc_writer
         self.indexer = indexer
 
     def write_records(self):
-        print('Writing {0} to {1} '.format(self.url, self.warcfilename))
-
-        with open(self.warcfilename, 'a+b') as out:
-            start = out.tell()
+        out = self._create_buffer()
+        try:
             resp_id = self._make_warc_id()
 
             self._write_warc_response(out, warc_id=resp_id)
             self._write_warc_request(out, concur_id=resp_id)
-            out.flush()
 
-            out.seek(start)
-            if self.indexer:
-                self.indexer.add_record(out, self.warcfilename)
+            self._write_and_index(out)
+        finally:
+            out.close()
 
     def add_user_record(self, url, content_type, data):
-        with open(self.warcfilename, 'a+b') as out:
-            start = out.tell()
+        out = self._create_buffer()
+        try:
             self._write_warc_metadata(out, url, content_type, data)
-            out.flush()
 
-            out.seek(start)
-            if self.indexer:
-                self.indexer.add_record(out, self.warcfilename)
+            self._write_and_index(out)
+        finally:
+            out.close()
+
+    def _write_and_index(self, out):
+        filename, offset = self.warc_writer.write_record(out)
+        print('Wrote {0} to {1}'.format(self.url, filename))
+
+        if self.indexer:
+            self.indexer.add_record(OffsetStream(out, offset), filename)
 
 
 # ============================================================================
@@ -0,0 +1,185 @@
+from ipfs.unixfs import UnixFSBuilder, b58encode, get_multihash, encode_varint
+from ipfs.car import RollingCARWriter, encode_car_header
+
+from io import BytesIO
+
+import os
+import shutil
+import tempfile
+
+
+# ============================================================================
+def build(data, **kwargs):
+    return list(UnixFSBuilder(**kwargs).build(BytesIO(data)))
+
+
+def read_varint(buff, pos):
+    value = 0
+    shift = 0
+    while True:
+        c = ord(buff[pos])
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if c < 0x80:
+            return value, pos
+
+
+def read_fields(buff):
+    pos = 0
+    while pos < len(buff):
+        key, pos = read_varint(buff, pos)
+        if key & 7 == 0:
+            value, pos = read_varint(buff, pos)
+        else:
+            length, pos = read_varint(buff, pos)
+            value = buff[pos:pos + length]
+            pos += length
+
+        yield key >> 3, value
+
+
+def read_node(block):
+    """ Return ([(hash, tsize)], {unixfs field: [values]}) of a dag-pb block
+    """
+    links = []
+    data = {}
+    for num, value in read_fields(block):
+        if num == 2:
+            link = dict(read_fields(value))
+            links.append((link[1], link[3]))
+        else:
+            for field, field_value in read_fields(value):
+                data.setdefault(field, []).append(field_value)
+
+    return links, data
+
+
+def read_file(blocks, multihash):
+    links, data = read_node(blocks[multihash])
+    return data.get(2, [''])[0] + ''.join(read_file(blocks, link) for link, _ in links)
+
+
+def subtree_size(blocks, multihash):
+    links, _ = read_node(blocks[multihash])
+    return len(blocks[multihash]) + sum(subtree_size(blocks, link) for link, _ in links)
+
+
+# ============================================================================
+def test_known_cids():
+    # as returned by 'ipfs add'
+    assert b58encode(build('hello world\n')[-1][0]) == 'QmT78zSuBmuS4z925WZfrqQ1qHaJ56DQaTfyMUF7F8ff5o'
+    assert b58encode(build('')[-1][0]) == 'QmbFMke1KXqnYyBBWxB74N4c5SBnJMVAiMNRcGu6x1AwQH'
+
+
+def test_b58encode():
+    assert b58encode('') == ''
+    assert b58encode('\x00\x00\x01') == '112'
+    assert b58encode('hello world') == 'StV1DL6CwTryKyV'
+
+
+def test_multi_chunk():
+    data = os.urandom(256*1024*2 + 1000)
+    blocks = build(data)
+
+    # three leaves, then the root
+    assert len(blocks) == 4
+    for multihash, block in blocks:
+        assert multihash == get_multihash(block)
+
+    blocks_by_hash = dict(blocks)
+    root = blocks[-1][0]
+
+    links, root_data = read_node(blocks_by_hash[root])
+    assert [link for link, _ in links] == [multihash for multihash, _ in blocks[:3]]
+    assert root_data == {1: [2], 3: [len(data)], 4: [256*1024, 256*1024, 1000]}
+
+    for link, tsize in links:
+        assert tsize == len(blocks_by_hash[link])
+
+        _, leaf_data = read_node(blocks_by_hash[link])
+        assert leaf_data[1] == [2]
+        assert leaf_data[3] == [len(leaf_data[2][0])]
+
+    assert read_file(blocks_by_hash, root) == data
+
+
+def test_balanced_layout():
+    data = os.urandom(4 * 10)
+    blocks = build(data, chunk_size=4, max_links=3)
+
+    # 10 leaves, 4 + 2 internal nodes, root
+    assert len(blocks) == 17
+
+    blocks_by_hash = dict(blocks)
+    root = blocks[-1][0]
+
+    links, _ = read_node(blocks_by_hash[root])
+    assert len(links) == 2
+
+    # first subtree is full, the last holds the single remaining leaf
+    first, _ = read_node(blocks_by_hash[links[0][0]])
+    assert len(first) == 3
+
+    last, _ = read_node(blocks_by_hash[links[1][0]])
+    assert len(last) == 1
+    assert len(read_node(blocks_by_hash[last[0][0]])[0]) == 1
+
+    for link, tsize in links:
+        assert tsize == subtree_size(blocks_by_hash, link)
+
+    assert read_file(blocks_by_hash, root) == data
+
+
+def test_car_header():
+    root = build('hello world\n')[-1][0]
+    header = ('\xa2' + '\x65roots' + '\x81' + '\xd8\x2a\x58\x23\x00' + root +
+              '\x67version\x01')
+
+    assert encode_car_header([root]) == encode_varint(len(header)) + header
+
+    # 24+ roots use a one byte length
+    header = encode_car_header([root] * 30)
+    assert header[len(encode_varint(len(header))) + 7:][:2] == '\x98\x1e'
+
+
+def test_recover_open_car():
+    dirname = tempfile.mkdtemp()
+    try:
+        closed = []
+        writer = RollingCARWriter(dirname, max_age=0, on_close=closed.append)
+
+        first = writer.write_record(BytesIO('first record'))
+        second = writer.write_record(BytesIO('second record'))
+
+        # a record partly written when the process stopped
+        writer.out.write(encode_varint(500) + 'partial')
+        writer.out.flush()
+
+        writer = RollingCARWriter(dirname, on_close=closed.append)
+        writer.recover()
+
+        assert len(closed) == 1
+        assert os.listdir(dirname) == [os.path.basename(closed[0])]
+
+        with open(closed[0], 'rb') as fh:
+            buff = fh.read()
+
+        header = encode_car_header([build('first record')[-1][0],
+                                    build('second record')[-1][0]])
+        assert buff.startswith(header)
+
+        assert [first, second] == [b58encode(build(data)[-1][0])
+                                   for data in ('first record', 'second record')]
+
+        # only whole sections after the header
+        pos = len(header)
+        while pos < len(buff):
+            length, pos = read_varint(buff, pos)
+            assert buff[pos:pos + 34] == get_multihash(buff[pos + 34:pos + length])
+            pos += length
+
+        assert pos == len(buff)
+
+    finally:
+        shutil.rmtree(dirname)
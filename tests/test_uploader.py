@@ -0,0 +1,76 @@
+from ipfs.uploader import IPFSUploader
+
+from io import BytesIO
+
+import hashlib
+import shutil
+import tempfile
+
+
+# ============================================================================
+class FakeAPI(object):
+    """ Rejects duplicate names in one add, as the daemon does
+    """
+    def __init__(self):
+        self.names = []
+
+    def add_many(self, streams):
+        names = [stream.name for stream in streams]
+        if len(set(names)) != len(names):
+            raise IOError('directory already has entry by that name')
+
+        self.names.append(names)
+        return [dict(Name=stream.name, Hash=sha1(stream.read()))
+                for stream in streams]
+
+
+class FakeIndexer(object):
+    def __init__(self):
+        self.records = []
+
+    def add_record(self, stream, path):
+        stream.seek(0)
+        self.records.append((stream.read(), path))
+
+
+def sha1(buff):
+    return hashlib.sha1(buff).hexdigest()
+
+
+# ============================================================================
+def test_batch_same_url():
+    spool_dir = tempfile.mkdtemp()
+    try:
+        api = FakeAPI()
+        indexer = FakeIndexer()
+        uploader = IPFSUploader(api, indexer, spool_dir, batch_size=2)
+
+        name = 'http%3A%2F%2Fexample.com%2F'
+        uploader.upload_batch([(BytesIO('first'), name, None),
+                               (BytesIO('second'), name, None)])
+
+        assert len(api.names) == 1
+        assert indexer.records == [('first', 'ipfs://' + sha1('first')),
+                                   ('second', 'ipfs://' + sha1('second'))]
+
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_batch_split():
+    spool_dir = tempfile.mkdtemp()
+    try:
+        api = FakeAPI()
+        indexer = FakeIndexer()
+        uploader = IPFSUploader(api, indexer, spool_dir, batch_size=2)
+
+        name = 'http%3A%2F%2Fexample.com%2F'
+        uploader.upload_batch([(BytesIO('headers:payload'), name, (8, 7)),
+                               (BytesIO('record'), name, None)])
+
+        assert len(api.names[0]) == 3
+        assert indexer.records == [('headers:payload', 'ipfs://' + sha1('headers:') + '+' + sha1('payload')),
+                                   ('record', 'ipfs://' + sha1('record'))]
+
+    finally:
+        shutil.rmtree(spool_dir)